@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Benchmark pricing e handler del bot.
+
+    python benchmark.py                               # Database finto in memoria
+    python benchmark.py --db postgres                 # Postgres usa e getta (DATABASE_URL)
+    python benchmark.py --save bench_baseline.json
+    python benchmark.py --compare bench_baseline.json --threshold 0.25
+
+Con --compare esce con codice 1 se la mediana di un caso peggiora oltre la soglia.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional
+
+# bot.py richiede queste variabili all'import
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/milano_bench")
+
+import bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+class FakeDatabase:
+    """Stessa interfaccia di Database usata da PricingEngine/handler, tutto in memoria"""
+
+    def __init__(self, events: Optional[List[Dict]] = None, market: Optional[Dict[date, float]] = None):
+        self.events = [bot.normalize_event(e) for e in events or []]
+        self.market = market or {}
+        self.suggestions: Dict[tuple, Dict] = {}
+        self.forecasts: Dict[str, Dict] = {}
+        self.audit_rows = 0
+        self.pushed: Dict[tuple, float] = {}
+
+    def load_events(self) -> List[Dict]:
+        return list(self.events)
+
+    def insert_events(self, events: List[Dict]):
+        self.events += [bot.normalize_event(e) for e in events]
+
+    def get_market_daily(self, start: date, end: date) -> List[Dict]:
+        return [
+            {"date": d, "n": 5, "avg_price": price}
+            for d, price in self.market.items()
+            if start <= d <= end
+        ]
+
+    def upsert_suggestions(self, suggestions: List[Dict]) -> set:
+        changed = set()
+        for s in suggestions:
+            key = (s.get("property_id", bot.DEFAULT_PROPERTY_ID), s["date"])
+            if self.suggestions.get(key) != s:
+                self.suggestions[key] = dict(s)
+                changed.add(key)
+        return changed
+
+    def insert_suggestion_audit(self, rows: List[tuple]):
+        self.audit_rows += len(rows)
+
+    def get_pushed_prices(self, property_id: int, start: date, end: date) -> Dict[date, float]:
+        return {d: price for (pid, d), price in self.pushed.items() if pid == property_id and start <= d <= end}
+
+    def save_pushed_prices(self, property_id: int, prices: Dict[date, float]):
+        self.pushed.update({(property_id, d): price for d, price in prices.items()})
+
+    def get_suggestions(self, start: date, end: date, property_id: int = bot.DEFAULT_PROPERTY_ID) -> List[Dict]:
+        return [
+            s for (pid, d), s in sorted(self.suggestions.items())
+            if pid == property_id and start <= d <= end
+        ]
+
+    def get_listings(self) -> List[Dict]:
+        return [dict(bot.DEFAULT_LISTING)]
+
+    def get_forecast_state(self, name: str) -> Optional[Dict]:
+        return self.forecasts.get(name)
+
+    def save_forecast_state(self, name: str, state: Dict):
+        self.forecasts[name] = state
+
+    def get_competitor_ids(self) -> Dict[str, int]:
+        return {}
+
+    def close(self):
+        pass
+
+
+def dense_events(start: date, count: int = 400, seed: int = 7) -> List[Dict]:
+    """Eventi sovrapposti: in media ~count*5/365 eventi per giorno"""
+    rng = random.Random(seed)
+    events = []
+    for i in range(count):
+        first = start + timedelta(days=rng.randrange(365))
+        events.append({
+            "name": f"Evento bench {i}",
+            "start": first.isoformat(),
+            "end": (first + timedelta(days=rng.randrange(1, 10))).isoformat(),
+            "impact": rng.randrange(1, 11),
+            "multiplier": round(rng.uniform(1.05, 2.5), 2),
+            "category": "bench",
+        })
+    return events
+
+
+def synthetic_market(start: date, days: int = 365, seed: int = 11) -> Dict[date, float]:
+    rng = random.Random(seed)
+    return {
+        start + timedelta(days=i): round(rng.uniform(90, 180), 2)
+        for i in range(days)
+        if rng.random() < 0.8
+    }
+
+
+def open_database(mode: str, events: List[Dict], market: Dict[date, float]):
+    """FakeDatabase in memoria, o Postgres usa e getta (DATABASE_URL) popolato con gli stessi dati"""
+    if mode != "postgres":
+        return FakeDatabase(events, market)
+    db = bot.Database(bot.DATABASE_URL)
+    db.init_schema()
+    db.insert_events(events)
+    ids = db.get_competitor_ids()
+    db.insert_price_history([
+        (competitor_id, day, price + offset, True)
+        for offset, competitor_id in enumerate(ids.values())
+        for day, price in market.items()
+    ])
+    return db
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies: List[str] = []
+
+    async def reply_text(self, text: str, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    def __init__(self):
+        self.message = FakeMessage()
+
+
+class FakeContext:
+    def __init__(self, args: Optional[List[str]] = None):
+        self.args = args or []
+
+
+def measure(func: Callable, repeat: int, warmup: int = 2) -> Dict:
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "median_ms": round(statistics.median(timings), 4),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        "min_ms": round(timings[0], 4),
+        "repeat": repeat,
+    }
+
+
+def build_cases(mode: str) -> Dict[str, Callable]:
+    today = date.today()
+    events = dense_events(today)
+    market = synthetic_market(today)
+
+    db = open_database(mode, events, market)
+
+    pricing = bot.PricingEngine(db)
+    bot.ListingPortfolio(db, pricing).refresh_all(today, today + timedelta(days=364))
+    index = pricing.events
+    index.reload()
+    handler_bot = bot.MilanoExpressBot(db)
+    # Con audit attivo: render/* includono il costo di SuggestionAudit.record
+    pricing.audit = handler_bot.audit
+    handler_bot.pricing = pricing
+    # Diff completo: nessun prezzo ancora inviato, tutto l'orizzonte da fondere in range
+    channel = bot.ChannelSync(db, bot.ListingPortfolio(db, pricing), client=bot.DryRunChannelManager())
+    loop = asyncio.new_event_loop()
+
+    def handler(name: str) -> Callable:
+        method = getattr(handler_bot, name)
+        return lambda: loop.run_until_complete(method(FakeUpdate(), FakeContext()))
+
+    cases = {
+        "pricing/single_date": lambda: pricing.calculate_optimal_price(today),
+        "pricing/range_7": lambda: pricing.calculate_price_range(today, today + timedelta(days=6)),
+        "pricing/range_90": lambda: pricing.calculate_price_range(today, today + timedelta(days=89)),
+        "pricing/range_365": lambda: pricing.calculate_price_range(today, today + timedelta(days=364)),
+        "pricing/arrays_365": lambda: pricing.calculate_price_arrays(today, today + timedelta(days=364)),
+        "events/lookup_dense": lambda: [index.get(today + timedelta(days=i)) for i in range(365)],
+        "events/range_dense": lambda: index.get_range(today, today + timedelta(days=364)),
+        "events/reload_dense": index.reload,
+        "handlers/oggi": handler("oggi"),
+        "handlers/domani": handler("domani"),
+        "handlers/settimana": handler("settimana"),
+        "handlers/eventi": handler("eventi"),
+        "render/oggi": lambda: handler_bot.render_oggi(today),
+        "render/settimana": lambda: handler_bot.render_settimana(today),
+        "render/eventi": lambda: handler_bot.render_eventi(today),
+        "export/calendario_365": lambda: handler_bot.build_calendar(today, 365),
+        "channel/plan_365": lambda: channel.plan(pricing, today, today + timedelta(days=364)),
+    }
+    if mode == "postgres":
+        cases["db/init_schema"] = db.init_schema
+    return cases
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results["cases"].items():
+        previous = baseline.get("cases", {}).get(name)
+        if not previous:
+            continue
+        ratio = result["median_ms"] / max(previous["median_ms"], 1e-6)
+        result["baseline_median_ms"] = previous["median_ms"]
+        result["change"] = round(ratio - 1, 3)
+        if ratio > 1 + threshold:
+            regressions.append(
+                f"{name}: {previous['median_ms']:.3f}ms -> {result['median_ms']:.3f}ms ({ratio - 1:+.0%})"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Milano Express Pricing Bot")
+    parser.add_argument("--db", choices=("fake", "postgres"), default="fake")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--filter", default="", help="esegue solo i casi che contengono questa stringa")
+    parser.add_argument("--save", metavar="FILE", help="scrive i risultati JSON (nuova baseline)")
+    parser.add_argument("--compare", metavar="FILE", help="baseline JSON da confrontare")
+    parser.add_argument("--threshold", type=float, default=0.25, help="peggioramento massimo della mediana")
+    args = parser.parse_args(argv)
+
+    cases = {name: func for name, func in build_cases(args.db).items() if args.filter in name}
+    results = {
+        "meta": {
+            "db": args.db,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "date": date.today().isoformat(),
+        },
+        "cases": {name: measure(func, args.repeat) for name, func in cases.items()},
+    }
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    for name, result in results["cases"].items():
+        change = f"  {result['change']:+.0%}" if "change" in result else ""
+        print(f"{name:<24} median {result['median_ms']:>9.3f}ms  p95 {result['p95_ms']:>9.3f}ms{change}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"\nRegressioni oltre {args.threshold:.0%}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,40 +4,103 @@ Milano Express - Pricing Bot v2.1 FINAL
 Calibrato su dati reali mercato Seveso/Milano Nord
 """
 
-import os
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from __future__ import annotations
 
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path in ("/healthz", "/"):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"ok")
-        else:
-            self.send_response(404)
-            self.end_headers()
+import time
 
-def start_health_server():
-    port = int(os.environ.get("PORT", "10000"))
-    server = HTTPServer(("0.0.0.0", port), HealthHandler)
-    server.serve_forever()
+_PROCESS_START = time.perf_counter()
 
-threading.Thread(target=start_health_server, daemon=True).start()
+import argparse
+import asyncio
+import csv
+import functools
+import hashlib
+import importlib
+import io
+import itertools
+import multiprocessing
 import logging
+import json
+import os
 import random
+import re
+import secrets
 import threading
-from datetime import datetime, timedelta, date
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, date, time as dtime
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Optional, Dict, List
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo
+
+
+class StartupTimer:
+    """Tempi di avvio: import per modulo e fasi fino alla prima risposta servita"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.imports: Dict[str, float] = {}
+        self.phases: Dict[str, float] = {}
+
+    @contextmanager
+    def importing(self, module: str):
+        started = time.perf_counter()
+        yield
+        self.imports[module] = time.perf_counter() - started
+
+    def mark(self, phase: str) -> bool:
+        """Registra la prima occorrenza di una fase (secondi dall'avvio del processo)"""
+        if phase in self.phases:
+            return False
+        self.phases[phase] = time.perf_counter() - self.started
+        return True
+
+    def report(self) -> str:
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        imports = ", ".join(
+            f"{name} {seconds * 1000:.0f}ms"
+            for name, seconds in sorted(self.imports.items(), key=lambda item: -item[1])
+        )
+        return f"Startup: {phases} | imports: {imports}"
+
+
+STARTUP = StartupTimer(_PROCESS_START)
+
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import requests
-import feedparser
-from bs4 import BeautifulSoup
-from telegram import Update, Bot
-from telegram.ext import Application, CommandHandler, ContextTypes
-from http.server import HTTPServer, BaseHTTPRequestHandler
+class LazyModule:
+    """Modulo importato al primo accesso a un attributo (scraping, feed, DB, NumPy).
+
+    Per rispondere al primo comando serve solo lo stack Telegram: il resto
+    viene caricato quando serve, e il tempo di import finisce in STARTUP.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            with STARTUP.importing(self._name):
+                self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = LazyModule("numpy")
+psycopg2 = LazyModule("psycopg2")
+psycopg2_extras = LazyModule("psycopg2.extras")
+psycopg2_pool = LazyModule("psycopg2.pool")
+requests = LazyModule("requests")
+feedparser = LazyModule("feedparser")
+bs4 = LazyModule("bs4")
+
+with STARTUP.importing("telegram"):
+    from telegram import Update, Bot
+    from telegram.error import NetworkError, RetryAfter
+    from telegram.ext import Application, CommandHandler, ContextTypes
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 # Logging
 logging.basicConfig(
@@ -52,6 +115,72 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 GROUP_CHAT_ID_RAW = os.environ.get("GROUP_CHAT_ID")
 GROUP_CHAT_ID = int(GROUP_CHAT_ID_RAW) if GROUP_CHAT_ID_RAW else None
 EVENTBRITE_TOKEN = os.environ.get("EVENTBRITE_TOKEN", "")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_HEALTHCHECK_IDLE = float(os.environ.get("DB_HEALTHCHECK_IDLE", "30"))
+SCHEMA_INIT_ATTEMPTS = int(os.environ.get("SCHEMA_INIT_ATTEMPTS", "6"))
+SUGGESTION_HORIZON_DAYS = int(os.environ.get("SUGGESTION_HORIZON_DAYS", "365"))
+SUGGESTION_REFRESH_HOURS = float(os.environ.get("SUGGESTION_REFRESH_HOURS", "6"))
+SCRAPER_ENABLED = os.environ.get("SCRAPER_ENABLED", "1") == "1"
+SCRAPER_CALENDAR_URL = os.environ.get("SCRAPER_CALENDAR_URL", "https://www.airbnb.it/rooms/{airbnb_id}")
+# User-Agent fisso e dichiarato: il bot si presenta per quello che è, senza fingersi un browser
+SCRAPER_USER_AGENT = os.environ.get(
+    "SCRAPER_USER_AGENT", "MilanoExpressPricingBot/1.0 (monitoraggio prezzi B&B Milano Express)"
+)
+SCRAPER_WORKERS = int(os.environ.get("SCRAPER_WORKERS", "5"))
+SCRAPER_MIN_INTERVAL = float(os.environ.get("SCRAPER_MIN_INTERVAL", "10"))
+SCRAPER_JITTER = float(os.environ.get("SCRAPER_JITTER", "8"))
+SCRAPER_HOUR = int(os.environ.get("SCRAPER_HOUR", "3"))
+PRICE_HISTORY_COMPACT_DAYS = int(os.environ.get("PRICE_HISTORY_COMPACT_DAYS", "90"))
+PRICE_HISTORY_DROP_MONTHS = int(os.environ.get("PRICE_HISTORY_DROP_MONTHS", "0"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", os.environ.get("RENDER_EXTERNAL_URL", ""))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+DIGEST_HOUR = int(os.environ.get("DIGEST_HOUR", "7"))
+WEEKLY_DIGEST_HOUR = int(os.environ.get("WEEKLY_DIGEST_HOUR", "8"))
+DIGEST_PREPARE_MINUTES = int(os.environ.get("DIGEST_PREPARE_MINUTES", "30"))
+EVENT_ALERT_IMPACT = int(os.environ.get("EVENT_ALERT_IMPACT", "7"))
+OUTBOUND_CHAT_INTERVAL = float(os.environ.get("OUTBOUND_CHAT_INTERVAL", "3"))
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "16"))
+CHAT_RATE_BURST = int(os.environ.get("CHAT_RATE_BURST", "5"))
+CHAT_RATE_PER_MINUTE = float(os.environ.get("CHAT_RATE_PER_MINUTE", "20"))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "25"))
+EVENT_FEED_URL = os.environ.get("EVENT_FEED_URL", "https://www.fieramilano.it/feed")
+EVENT_FEED_REFRESH_HOURS = float(os.environ.get("EVENT_FEED_REFRESH_HOURS", "6"))
+EVENT_FEED_IMPACT = int(os.environ.get("EVENT_FEED_IMPACT", "5"))
+EVENT_FEED_MULTIPLIER = float(os.environ.get("EVENT_FEED_MULTIPLIER", "1.2"))
+SIM_WORKERS = int(os.environ.get("SIM_WORKERS", "1"))
+# Sotto questa soglia il process pool (spawn: ~4 s per riavviare bot e NumPy nei worker)
+# costa più della griglia in-process (~0.2 ms per config su 365 giorni)
+SIM_POOL_MIN_CONFIGS = int(os.environ.get("SIM_POOL_MIN_CONFIGS", "30000"))
+SIM_BASE_OCCUPANCY = float(os.environ.get("SIM_BASE_OCCUPANCY", "0.7"))
+SIM_ELASTICITY = float(os.environ.get("SIM_ELASTICITY", "1.5"))
+MARKET_FORECAST_ALPHA = float(os.environ.get("MARKET_FORECAST_ALPHA", "0.05"))
+MARKET_FORECAST_GAMMA = float(os.environ.get("MARKET_FORECAST_GAMMA", "0.1"))
+MARKET_FORECAST_MIN_OBS = int(os.environ.get("MARKET_FORECAST_MIN_OBS", "30"))
+MARKET_FORECAST_CONFIDENCE = float(os.environ.get("MARKET_FORECAST_CONFIDENCE", "0.08"))
+PRICING_CATALOG_PATH = os.environ.get("PRICING_CATALOG_PATH", "")
+CATALOG_WATCH_SECONDS = float(os.environ.get("CATALOG_WATCH_SECONDS", "30"))
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_SECONDS = float(os.environ.get("AUDIT_FLUSH_SECONDS", "10"))
+AUDIT_MAX_PENDING = int(os.environ.get("AUDIT_MAX_PENDING", "20000"))
+AUDIT_RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", "400"))
+CHANNEL_MANAGER = os.environ.get("CHANNEL_MANAGER", "http")
+CHANNEL_MANAGER_URL = os.environ.get("CHANNEL_MANAGER_URL", "")
+CHANNEL_MANAGER_TOKEN = os.environ.get("CHANNEL_MANAGER_TOKEN", "")
+CHANNEL_MANAGER_MIN_INTERVAL = float(os.environ.get("CHANNEL_MANAGER_MIN_INTERVAL", "1"))
+CHANNEL_PUSH_BATCH = int(os.environ.get("CHANNEL_PUSH_BATCH", "100"))
+CHANNEL_SYNC_MINUTES = float(os.environ.get("CHANNEL_SYNC_MINUTES", "15"))
+# codice proprietà -> id dell'annuncio sul channel manager ("milano-express=12345,..."), default il codice
+CHANNEL_MANAGER_LISTINGS = dict(
+    part.split("=", 1)
+    for part in os.environ.get("CHANNEL_MANAGER_LISTINGS", "").replace(" ", "").split(",")
+    if "=" in part
+)
+ADMIN_USER_IDS = {int(x) for x in os.environ.get("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x}
+
+ROME_TZ = ZoneInfo("Europe/Rome")
 
 if not BOT_TOKEN:
     raise RuntimeError("Missing BOT_TOKEN")
@@ -68,6 +197,16 @@ PRICES_CONFIG = {
     "SUNDAY_DISCOUNT": 0.95,
 }
 
+# Griglia di default per /simula e `bot.py simula`: valori candidati per chiave.
+# EVENT_SCALE scala tutti i moltiplicatori evento (1.0 = FIXED_EVENTS_2026 invariati)
+SIM_DEFAULT_GRID = {
+    "BASE_WEEKDAY": [70, 75, 80, 85, 90, 95],
+    "BASE_WEEKEND": [95, 105, 115, 125],
+    "WEEKEND_MULTIPLIER": [1.0, 1.1, 1.15, 1.2],
+    "SUNDAY_DISCOUNT": [0.9, 0.95, 1.0],
+    "EVENT_SCALE": [0.8, 0.9, 1.0, 1.1],
+}
+
 # EVENTI FISSI 2026 - Moltiplicatori calibrati su mercato reale
 FIXED_EVENTS_2026 = [
     {
@@ -152,6 +291,269 @@ FIXED_EVENTS_2026 = [
     },
 ]
 
+# Migrazioni schema: (versione, descrizione, SQL). Non modificare mai una
+# migrazione già rilasciata: aggiungerne una nuova in coda alla lista.
+MIGRATIONS = [
+    (1, "schema iniziale", """
+    CREATE TABLE IF NOT EXISTS competitors (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        airbnb_id TEXT UNIQUE NOT NULL,
+        url TEXT NOT NULL,
+        active BOOLEAN DEFAULT true,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS price_history (
+        id SERIAL PRIMARY KEY,
+        competitor_id INTEGER REFERENCES competitors(id),
+        date DATE NOT NULL,
+        price DECIMAL(10,2),
+        available BOOLEAN DEFAULT true,
+        scraped_at TIMESTAMP DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS events (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        start_date DATE NOT NULL,
+        end_date DATE NOT NULL,
+        category TEXT,
+        impact_score INTEGER,
+        multiplier DECIMAL(5,2),
+        created_at TIMESTAMP DEFAULT NOW(),
+        UNIQUE(name, start_date, end_date)
+    );
+
+    CREATE TABLE IF NOT EXISTS pricing_suggestions (
+        id SERIAL PRIMARY KEY,
+        date DATE UNIQUE NOT NULL,
+        suggested_price DECIMAL(10,2) NOT NULL,
+        base_price DECIMAL(10,2),
+        market_avg DECIMAL(10,2),
+        event_multiplier DECIMAL(5,2),
+        event_name TEXT,
+        reasoning JSONB,
+        confidence DECIMAL(5,2),
+        applied BOOLEAN DEFAULT false,
+        created_at TIMESTAMP DEFAULT NOW(),
+        updated_at TIMESTAMP DEFAULT NOW()
+    );
+
+    ALTER TABLE pricing_suggestions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT NOW();
+
+    CREATE INDEX IF NOT EXISTS idx_price_date ON price_history(date);
+    CREATE INDEX IF NOT EXISTS idx_event_dates ON events(start_date, end_date);
+    CREATE INDEX IF NOT EXISTS idx_suggestions_date ON pricing_suggestions(date);
+    """),
+    (2, "rollup giornaliero mercato", """
+    CREATE TABLE IF NOT EXISTS market_daily (
+        date DATE PRIMARY KEY,
+        n INTEGER NOT NULL,
+        sum_price DECIMAL(14,2) NOT NULL,
+        min_price DECIMAL(10,2),
+        max_price DECIMAL(10,2),
+        median_price DECIMAL(10,2),
+        updated_at TIMESTAMP DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_price_history_market
+        ON price_history(date) INCLUDE (price)
+        WHERE available = true AND price > 0;
+
+    INSERT INTO market_daily (date, n, sum_price, min_price, max_price, median_price)
+    SELECT date, COUNT(*), SUM(price), MIN(price), MAX(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price)
+    FROM price_history
+    WHERE available = true AND price > 0
+    GROUP BY date
+    ON CONFLICT (date) DO NOTHING;
+    """),
+    (3, "price_history partizionata per mese e solo variazioni", """
+    CREATE TABLE IF NOT EXISTS price_latest (
+        competitor_id INTEGER NOT NULL REFERENCES competitors(id),
+        date DATE NOT NULL,
+        price DECIMAL(10,2),
+        available BOOLEAN,
+        last_seen_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (competitor_id, date)
+    );
+
+    ALTER TABLE price_history RENAME TO price_history_legacy;
+    ALTER TABLE price_history_legacy RENAME CONSTRAINT price_history_pkey TO price_history_legacy_pkey;
+    ALTER INDEX IF EXISTS idx_price_date RENAME TO idx_price_date_legacy;
+    ALTER INDEX IF EXISTS idx_price_history_market RENAME TO idx_price_history_market_legacy;
+
+    CREATE TABLE price_history (
+        id BIGSERIAL,
+        competitor_id INTEGER REFERENCES competitors(id),
+        date DATE NOT NULL,
+        price DECIMAL(10,2),
+        available BOOLEAN DEFAULT true,
+        scraped_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, scraped_at)
+    ) PARTITION BY RANGE (scraped_at);
+
+    CREATE OR REPLACE FUNCTION ensure_price_history_partition(month DATE) RETURNS void AS $$
+    DECLARE
+        start_month DATE := date_trunc('month', month)::date;
+    BEGIN
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF price_history FOR VALUES FROM (%L) TO (%L)',
+            'price_history_' || to_char(start_month, 'YYYY_MM'),
+            start_month,
+            (start_month + INTERVAL '1 month')::date
+        );
+    END $$ LANGUAGE plpgsql;
+
+    SELECT ensure_price_history_partition(m::date)
+    FROM generate_series(
+        date_trunc('month', COALESCE((SELECT MIN(scraped_at) FROM price_history_legacy), NOW())),
+        date_trunc('month', NOW()),
+        INTERVAL '1 month'
+    ) AS m;
+
+    -- Dallo storico si tengono solo le osservazioni che cambiano prezzo/disponibilità
+    INSERT INTO price_history (competitor_id, date, price, available, scraped_at)
+    SELECT competitor_id, date, price, available, scraped_at FROM (
+        SELECT competitor_id, date, price, available, COALESCE(scraped_at, NOW()) AS scraped_at,
+               LAG(price) OVER w AS prev_price,
+               LAG(available) OVER w AS prev_available,
+               ROW_NUMBER() OVER w AS rn
+        FROM price_history_legacy
+        WINDOW w AS (PARTITION BY competitor_id, date ORDER BY scraped_at)
+    ) t
+    WHERE rn = 1 OR price IS DISTINCT FROM prev_price OR available IS DISTINCT FROM prev_available;
+
+    INSERT INTO price_latest (competitor_id, date, price, available, last_seen_at)
+    SELECT DISTINCT ON (competitor_id, date) competitor_id, date, price, available, scraped_at
+    FROM price_history_legacy
+    WHERE competitor_id IS NOT NULL
+    ORDER BY competitor_id, date, scraped_at DESC;
+
+    DROP TABLE price_history_legacy;
+
+    CREATE INDEX IF NOT EXISTS idx_price_date ON price_history(date);
+    CREATE INDEX IF NOT EXISTS idx_price_history_market
+        ON price_history(date) INCLUDE (price)
+        WHERE available = true AND price > 0;
+
+    TRUNCATE market_daily;
+    INSERT INTO market_daily (date, n, sum_price, min_price, max_price, median_price)
+    SELECT date, COUNT(*), SUM(price), MIN(price), MAX(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price)
+    FROM price_history
+    WHERE available = true AND price > 0
+    GROUP BY date;
+    """),
+    (4, "stato feed eventi per ingestione incrementale", """
+    CREATE TABLE IF NOT EXISTS feed_state (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        checked_at TIMESTAMP DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS feed_entries_seen (
+        entry_hash TEXT PRIMARY KEY,
+        feed_url TEXT NOT NULL,
+        seen_at TIMESTAMP DEFAULT NOW()
+    );
+    """),
+    (5, "più proprietà: configurazione, set competitivo e suggerimenti per proprietà", """
+    CREATE TABLE IF NOT EXISTS properties (
+        id SERIAL PRIMARY KEY,
+        code TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        config JSONB NOT NULL DEFAULT '{}',
+        active BOOLEAN DEFAULT true,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+
+    -- La proprietà storica ha id 1: i suggerimenti esistenti le appartengono
+    INSERT INTO properties (id, code, name) VALUES (1, 'milano-express', 'Milano Express B&B')
+    ON CONFLICT DO NOTHING;
+    SELECT setval(pg_get_serial_sequence('properties', 'id'), (SELECT MAX(id) FROM properties));
+
+    CREATE TABLE IF NOT EXISTS property_competitors (
+        property_id INTEGER NOT NULL REFERENCES properties(id) ON DELETE CASCADE,
+        competitor_id INTEGER NOT NULL REFERENCES competitors(id) ON DELETE CASCADE,
+        PRIMARY KEY (property_id, competitor_id)
+    );
+
+    ALTER TABLE pricing_suggestions
+        ADD COLUMN IF NOT EXISTS property_id INTEGER NOT NULL DEFAULT 1 REFERENCES properties(id);
+    ALTER TABLE pricing_suggestions DROP CONSTRAINT IF EXISTS pricing_suggestions_date_key;
+    ALTER TABLE pricing_suggestions
+        ADD CONSTRAINT pricing_suggestions_property_date_key UNIQUE (property_id, date);
+    DROP INDEX IF EXISTS idx_suggestions_date;
+    """),
+    (6, "stato della previsione di mercato (smoothing esponenziale)", """
+    CREATE TABLE IF NOT EXISTS market_forecast (
+        name TEXT PRIMARY KEY,
+        state JSONB NOT NULL,
+        updated_at TIMESTAMP DEFAULT NOW()
+    );
+    """),
+    (7, "catalogo prezzi/eventi versionato, ricaricabile senza riavvio", """
+    -- Una riga per versione: vale l'ultima. prices sovrascrive PRICES_CONFIG,
+    -- events (se non NULL) sostituisce FIXED_EVENTS_2026
+    CREATE TABLE IF NOT EXISTS pricing_catalog (
+        version SERIAL PRIMARY KEY,
+        prices JSONB NOT NULL DEFAULT '{}',
+        events JSONB,
+        note TEXT,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+
+    -- Eventi provenienti dal catalogo: tolti dalla tabella quando escono dal catalogo
+    ALTER TABLE events ADD COLUMN IF NOT EXISTS catalog BOOLEAN NOT NULL DEFAULT false;
+    """),
+    (8, "audit append-only dei suggerimenti serviti", """
+    CREATE TABLE IF NOT EXISTS suggestion_audit (
+        id BIGSERIAL PRIMARY KEY,
+        computed_at TIMESTAMPTZ NOT NULL,
+        source TEXT NOT NULL,
+        property_id INTEGER NOT NULL,
+        date DATE NOT NULL,
+        suggested_price DECIMAL(10,2) NOT NULL,
+        base_price DECIMAL(10,2),
+        market_avg DECIMAL(10,2),
+        event_multiplier DECIMAL(5,2),
+        event_name TEXT,
+        reasoning JSONB,
+        confidence DECIMAL(5,2),
+        catalog_version INTEGER
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_suggestion_audit_property_date ON suggestion_audit(property_id, date);
+    CREATE INDEX IF NOT EXISTS idx_suggestion_audit_computed ON suggestion_audit(computed_at);
+    """),
+    (9, "ultimo prezzo inviato al channel manager per proprietà e data", """
+    CREATE TABLE IF NOT EXISTS channel_push_state (
+        property_id INTEGER NOT NULL REFERENCES properties(id) ON DELETE CASCADE,
+        date DATE NOT NULL,
+        price DECIMAL(10,2) NOT NULL,
+        pushed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (property_id, date)
+    );
+    """),
+    (10, "market_daily dall'osservazione corrente per competitor (price_latest)", """
+    CREATE INDEX IF NOT EXISTS idx_price_latest_date ON price_latest(date) INCLUDE (price)
+        WHERE available = true AND price > 0;
+    -- Le mediane ora si leggono da price_latest
+    DROP INDEX IF EXISTS idx_price_history_market;
+
+    TRUNCATE market_daily;
+    INSERT INTO market_daily (date, n, sum_price, min_price, max_price, median_price)
+    SELECT date, COUNT(*), SUM(price), MIN(price), MAX(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price)
+    FROM price_latest
+    WHERE available = true AND price > 0
+    GROUP BY date;
+    """),
+]
+
 # Competitor (per futura integrazione)
 COMPETITORS = [
     {
@@ -181,270 +583,2678 @@ COMPETITORS = [
     },
 ]
 
+# Proprietà gestite. "config" sovrascrive le chiavi di PRICES_CONFIG (anche
+# EVENT_SCALE); "competitors" è il set competitivo (airbnb_id), None = tutti i
+# competitor con la media da market_daily. La prima è la proprietà storica (id 1).
+PROPERTIES = [
+    {
+        "code": "milano-express",
+        "name": "Milano Express B&B",
+        "config": {},
+        "competitors": None,
+    },
+]
+
+DEFAULT_PROPERTY_ID = 1
+DEFAULT_LISTING = {
+    "id": DEFAULT_PROPERTY_ID,
+    "code": PROPERTIES[0]["code"],
+    "name": PROPERTIES[0]["name"],
+    "config": {},
+    "competitor_ids": None,
+}
+
+
+class Metrics:
+    """Contatori, gauge e istogrammi in memoria, esposti in formato Prometheus su /metrics"""
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {}
+        self._values: Dict[str, Dict[tuple, object]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self._meta[name] = (kind, help_text, buckets)
+        self._values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def record_cache(self, cache: str, hit: int, miss: int = 0):
+        """Hit/miss di una cache e relativo hit ratio cumulativo"""
+        if hit:
+            self.inc("cache_requests_total", hit, cache=cache, result="hit")
+        if miss:
+            self.inc("cache_requests_total", miss, cache=cache, result="miss")
+        with self._lock:
+            series = self._values["cache_requests_total"]
+            hits = series.get((("cache", cache), ("result", "hit")), 0.0)
+            total = hits + series.get((("cache", cache), ("result", "miss")), 0.0)
+        if total:
+            self.set("cache_hit_ratio", hits / total, cache=cache)
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        pairs = key + extra
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._labels(key)} {value:g}")
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{self._labels(key, (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total:.6f}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("bot_command_duration_seconds", "histogram", "Durata handler comandi Telegram")
+METRICS.describe("bot_command_errors_total", "counter", "Eccezioni negli handler comandi")
+METRICS.describe("db_query_duration_seconds", "histogram", "Durata query per tipo (inclusa attesa del pool)")
+METRICS.describe("db_query_errors_total", "counter", "Query fallite per tipo")
+METRICS.describe("db_pool_size", "gauge", "Connessioni massime del pool")
+METRICS.describe("startup_seconds", "gauge", "Secondi dall'avvio del processo per fase (schema, bot, primo comando)")
+METRICS.describe("startup_import_seconds", "gauge", "Tempo di import per modulo")
+METRICS.describe("db_connections_in_use", "gauge", "Connessioni prese dal pool")
+METRICS.describe("db_connections_dropped_total", "counter", "Connessioni scartate (morte o stale)")
+METRICS.describe("cache_requests_total", "counter", "Lookup in cache per esito")
+METRICS.describe("cache_hit_ratio", "gauge", "Hit ratio cumulativo per cache")
+METRICS.describe("outbound_messages_total", "counter", "Messaggi in uscita per esito (sent/throttled/failed)")
+METRICS.describe("updates_throttled_total", "counter", "Comandi rifiutati per superamento del limite per utente")
+METRICS.describe("suggestion_audit_rows_total", "counter", "Righe audit suggerimenti per esito (written/failed/dropped)")
+METRICS.describe("suggestion_audit_pending", "gauge", "Righe audit in coda in memoria")
+METRICS.describe("channel_push_requests_total", "counter", "Chiamate al channel manager per esito (ok/failed)")
+METRICS.describe("channel_push_dates_total", "counter", "Date con prezzo cambiato inviate al channel manager")
+METRICS.describe("singleflight_total", "counter", "Calcoli condivisi per tipo (run = eseguito, shared = atteso)")
+METRICS.describe(
+    "event_loop_lag_seconds", "histogram", "Ritardo dell'event loop asyncio",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def query_label(query: str) -> str:
+    """'SELECT ... FROM pricing_suggestions ...' -> 'select pricing_suggestions'"""
+    verb = query.lstrip().split(None, 1)[0].lower() if query.strip() else "query"
+    match = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?)\s+([a-z_][a-z0-9_]*)", query, re.I)
+    return f"{verb} {match[1].lower()}" if match else verb
+
+
+def instrument_command(command: str, handler, throttle: Optional["ChatThrottle"] = None):
+    """Wrapper per CommandHandler: limite per utente, latenza ed errori per comando.
+
+    Il limite si applica solo ai comandi riconosciuti (il wrapper gira dopo il
+    filtro del CommandHandler): messaggi normali, modifiche e ingressi nel
+    gruppo non consumano token.
+    """
+
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat, user = update.effective_chat, update.effective_user
+        key = (chat.id if chat else None, user.id if user else None)
+        if throttle is not None and not throttle.allow(key):
+            METRICS.inc("updates_throttled_total", command=command)
+            if throttle.warn(key) and update.effective_message is not None:
+                await update.effective_message.reply_text("⏳ Troppo veloce: riprova tra qualche secondo.")
+            return
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            METRICS.inc("bot_command_errors_total", command=command)
+            raise
+        finally:
+            METRICS.observe("bot_command_duration_seconds", time.perf_counter() - started, command=command)
+            if STARTUP.mark("first_command"):
+                logger.info(STARTUP.report())
+
+    return wrapper
+
+
+async def monitor_event_loop(interval: float = 1.0):
+    """Misura di quanto l'event loop ritarda un risveglio programmato"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        METRICS.observe("event_loop_lag_seconds", max(0.0, loop.time() - started - interval))
+
 
 class Database:
-    def __init__(self, url: str):
-        self.url = url
-        self.conn = None
+    """Accesso Postgres tramite pool di connessioni limitato.
 
-    def connect(self):
-        if not self.conn or self.conn.closed:
-            self.conn = psycopg2.connect(self.url)
-        return self.conn
+    execute() è sincrono e thread-safe; gli handler async usano aexecute()
+    (o asyncio.to_thread) per non bloccare l'event loop di Telegram.
+    """
 
-    def execute(self, query: str, params: tuple = None, fetch: bool = False):
-        conn = self.connect()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query, params)
-            if fetch:
-                return cur.fetchall()
-            conn.commit()
+    def __init__(self, url: str, pool_size: int = DB_POOL_SIZE):
+        self.url = url
+        self.pool_size = pool_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # getconn() del pool fallisce se esaurito: il semaforo fa attendere invece
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._last_used: Dict[int, float] = {}
+        self._in_use = 0
+        # Migrazioni in background (init_schema_background): le query attendono qui
+        self._schema_ready = threading.Event()
+        self._schema_ready.set()
+        self._schema_thread: Optional[threading.Thread] = None
+        self._schema_error: Optional[Exception] = None
+        METRICS.set("db_pool_size", pool_size)
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = psycopg2_pool.ThreadedConnectionPool(1, self.pool_size, self.url)
+        return self._pool
+
+    def _checkout(self, pool):
+        """Prende una connessione dal pool verificando che sia ancora viva.
+
+        Anche la connessione presa al posto di una scartata viene verificata:
+        dopo un riavvio di Postgres tutte quelle inattive nel pool sono morte.
+        """
+        for _ in range(self.pool_size + 1):
+            conn = pool.getconn()
+            if not conn.closed and self._alive(conn):
+                return conn
+            logger.warning("Dropping stale database connection")
+            METRICS.inc("db_connections_dropped_total")
+            self._last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("no live database connection available")
+
+    def _alive(self, conn) -> bool:
+        """SELECT 1 solo se la connessione è inattiva da più di DB_HEALTHCHECK_IDLE"""
+        if id(conn) in self._last_used and time.monotonic() - self._last_used[id(conn)] <= DB_HEALTHCHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            pool = self._get_pool()
+            conn = self._checkout(pool)
+            self._track_in_use(1)
+            broken = False
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._last_used[id(conn)] = time.monotonic()
+                pool.putconn(conn, close=broken or bool(conn.closed))
+                self._track_in_use(-1)
+
+    def _track_in_use(self, delta: int):
+        with self._pool_lock:
+            self._in_use += delta
+            METRICS.set("db_connections_in_use", self._in_use)
+
+    def _run(self, work, label: str = "query"):
+        self._wait_schema()
+        with METRICS.timer("db_query_duration_seconds", query=label):
+            try:
+                return self._run_with_retry(work)
+            except Exception:
+                METRICS.inc("db_query_errors_total", query=label)
+                raise
+
+    def _run_with_retry(self, work):
+        """Un nuovo tentativo solo se la connessione cade prima del COMMIT.
+
+        Prima del COMMIT la transazione viene annullata dal server e si può
+        ripetere; un errore sul COMMIT è ambiguo (il server può averlo già
+        applicato) e viene rilanciato, così un lavoro non idempotente non
+        viene eseguito due volte.
+        """
+        for attempt in range(2):
+            committing = False
+            try:
+                with self.connection() as conn:
+                    result = work(conn)
+                    committing = True
+                    conn.commit()
+                    return result
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # Connessione caduta (es. Postgres riavviato): un solo nuovo tentativo
+                if attempt or committing:
+                    raise
+                logger.warning(f"Database connection lost, reconnecting: {e}")
         return None
 
+    def execute(self, query: str, params: tuple = None, fetch: bool = False):
+        def work(conn):
+            with conn.cursor(cursor_factory=psycopg2_extras.RealDictCursor) as cur:
+                cur.execute(query, params)
+                return cur.fetchall() if fetch else None
+
+        return self._run(work, query_label(query))
+
+    def execute_values(self, query: str, rows: List[tuple], template: str = None, fetch: bool = False):
+        """INSERT multi-riga (VALUES %s) in un solo round-trip"""
+        if not rows:
+            return [] if fetch else None
+
+        def work(conn):
+            with conn.cursor(cursor_factory=psycopg2_extras.RealDictCursor) as cur:
+                return psycopg2_extras.execute_values(
+                    cur, query, rows, template=template, page_size=len(rows), fetch=fetch
+                )
+
+        return self._run(work, query_label(query))
+
+    async def aexecute(self, query: str, params: tuple = None, fetch: bool = False):
+        return await asyncio.to_thread(self.execute, query, params, fetch)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+
+    def schema_version(self) -> int:
+        """Versione applicata (0 su database vuoto), senza creare tabelle: lettura senza lock"""
+        results = self.execute("SELECT to_regclass('schema_migrations') IS NOT NULL AS present", fetch=True)
+        if not results[0]["present"]:
+            return 0
+        results = self.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations", fetch=True)
+        return results[0]["version"]
+
+    def _wait_schema(self):
+        if threading.current_thread() is self._schema_thread:
+            return
+        self._schema_ready.wait()
+        if self._schema_error is not None:
+            raise RuntimeError(f"Database schema initialization failed: {self._schema_error}")
+
+    def init_schema_background(self, attempts: int = SCHEMA_INIT_ATTEMPTS) -> threading.Thread:
+        """init_schema in un thread: il bot si avvia in parallelo alle migrazioni.
+
+        Le query arrivate nel frattempo attendono la fine delle migrazioni
+        invece di trovare tabelle mancanti; /start e /help rispondono subito.
+        Se il database non risponde (es. Postgres free che si sta svegliando)
+        riprova con backoff (2, 4, 8... s); dopo attempts tentativi il processo
+        termina con codice 1 e Render lo riavvia, invece di restare attivo
+        con tutte le query che falliscono.
+        """
+
+        def work():
+            error: Optional[Exception] = None
+            for attempt in range(1, attempts + 1):
+                try:
+                    self.init_schema()
+                    STARTUP.mark("schema_ready")
+                    self._schema_ready.set()
+                    return
+                except Exception as e:
+                    error = e
+                    if attempt == attempts:
+                        break
+                    delay = min(2 ** attempt, 60)
+                    logger.warning(
+                        f"Database schema initialization failed (attempt {attempt}/{attempts}), "
+                        f"retrying in {delay}s: {e}"
+                    )
+                    time.sleep(delay)
+            logger.critical(f"Database schema initialization failed after {attempts} attempts: {error}")
+            self._schema_error = error
+            self._schema_ready.set()
+            logging.shutdown()
+            os._exit(1)
+
+        self._schema_ready.clear()
+        self._schema_thread = threading.Thread(target=work, name="init-schema", daemon=True)
+        self._schema_thread.start()
+        return self._schema_thread
+
     def init_schema(self):
-        # Drop old schema if exists (per fix colonna source)
-        drop_schema = """
-        DROP TABLE IF EXISTS price_adjustments CASCADE;
-        DROP TABLE IF EXISTS pricing_suggestions CASCADE;
-        DROP TABLE IF EXISTS price_history CASCADE;
-        DROP TABLE IF EXISTS events CASCADE;
-        DROP TABLE IF EXISTS competitors CASCADE;
+        """Applica solo le migrazioni mancanti (mai DROP) e aggiorna i dati fissi"""
+        if self.schema_version() < MIGRATIONS[-1][0]:
+
+            def migrate(conn):
+                with conn.cursor() as cur:
+                    # Un solo processo alla volta applica le migrazioni (es. due istanze
+                    # durante un deploy): dopo il lock si rilegge la versione, perché
+                    # l'altro processo può averle già applicate
+                    cur.execute("SELECT pg_advisory_xact_lock(20260101)")
+                    cur.execute(
+                        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                        "version INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP DEFAULT NOW())"
+                    )
+                    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                    current = cur.fetchone()[0]
+                    for version, description, sql in MIGRATIONS:
+                        if version <= current:
+                            continue
+                        cur.execute(sql)
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s) "
+                            "ON CONFLICT (version) DO NOTHING",
+                            (version, description),
+                        )
+                        logger.info(f"Applied migration {version}: {description}")
+
+            self._run(migrate, "migrate")
+        logger.info(f"Database schema initialized (version {MIGRATIONS[-1][0]})")
+
+        try:
+            CATALOG.reload(self)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Pricing catalog not loaded, using built-in defaults: {e}")
+        self.seed()
+        logger.info("Initial data loaded")
+
+    def seed(self):
+        """Competitor, eventi del catalogo e proprietà: un upsert bulk per tabella, un solo round-trip"""
+
+        def work(conn):
+            with conn.cursor() as cur:
+                competitors = b",".join(
+                    cur.mogrify("(%s, %s, %s)", (c["name"], c["airbnb_id"], c["url"]))
+                    for c in COMPETITORS
+                )
+                properties = b",".join(
+                    cur.mogrify("(%s, %s, %s)", (p["code"], p["name"], psycopg2_extras.Json(p.get("config") or {})))
+                    for p in PROPERTIES
+                )
+                links = b",".join(
+                    cur.mogrify("(%s, %s)", (p["code"], airbnb_id))
+                    for p in PROPERTIES
+                    for airbnb_id in p.get("competitors") or []
+                )
+                sql = (
+                    b"INSERT INTO competitors (name, airbnb_id, url) VALUES " + competitors
+                    + b" ON CONFLICT (airbnb_id) DO UPDATE SET name = EXCLUDED.name, url = EXCLUDED.url; "
+                    + self._catalog_events_sql(cur, CATALOG.snapshot.events)
+                    + b"INSERT INTO properties (code, name, config) VALUES " + properties
+                    + b" ON CONFLICT (code) DO UPDATE SET name = EXCLUDED.name, config = EXCLUDED.config; "
+                    + cur.mogrify(
+                        "DELETE FROM property_competitors WHERE property_id IN "
+                        "(SELECT id FROM properties WHERE code = ANY(%s)); ",
+                        ([p["code"] for p in PROPERTIES],),
+                    )
+                )
+                if links:
+                    sql += (
+                        b"INSERT INTO property_competitors (property_id, competitor_id) "
+                        b"SELECT p.id, c.id FROM (VALUES " + links + b") AS v (code, airbnb_id) "
+                        b"JOIN properties p ON p.code = v.code JOIN competitors c ON c.airbnb_id = v.airbnb_id "
+                        b"ON CONFLICT DO NOTHING"
+                    )
+                cur.execute(sql)
+
+        self._run(work, "seed")
+
+    _EVENTS_CONFLICT = (
+        "ON CONFLICT (name, start_date, end_date) DO UPDATE SET "
+        "category = EXCLUDED.category, impact_score = EXCLUDED.impact_score, "
+        "multiplier = EXCLUDED.multiplier"
+    )
+
+    @staticmethod
+    def _event_row(event: Dict) -> tuple:
+        event = normalize_event(event)
+        return (
+            event["name"],
+            event["start_date"],
+            event["end_date"],
+            event["category"],
+            event["impact_score"],
+            event["multiplier"],
+        )
+
+    def insert_events(self, events: List[Dict]):
+        self.execute_values(
+            "INSERT INTO events (name, start_date, end_date, category, impact_score, multiplier) "
+            "VALUES %s " + self._EVENTS_CONFLICT,
+            [self._event_row(e) for e in events],
+        )
+
+    def _catalog_events_sql(self, cur, events) -> bytes:
+        """Upsert degli eventi del catalogo e DELETE di quelli non più presenti"""
+        keys = [event_key(e) for e in events]
+        sql = cur.mogrify(
+            "DELETE FROM events WHERE catalog AND (name, start_date, end_date) NOT IN "
+            "(SELECT * FROM unnest(%s::text[], %s::date[], %s::date[])); ",
+            ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys]),
+        )
+        if events:
+            rows = b",".join(cur.mogrify("(%s, %s, %s, %s, %s, %s, true)", self._event_row(e)) for e in events)
+            sql += (
+                b"INSERT INTO events (name, start_date, end_date, category, impact_score, multiplier, catalog) "
+                b"VALUES " + rows + b" " + self._EVENTS_CONFLICT.encode() + b", catalog = true; "
+            )
+        return sql
+
+    def sync_catalog_events(self, events):
+        """Allinea la tabella events al catalogo (dopo /ricarica), in una transazione"""
+
+        def work(conn):
+            with conn.cursor() as cur:
+                cur.execute(self._catalog_events_sql(cur, events))
+
+        self._run(work, "sync_catalog_events")
+
+    def get_pricing_catalog(self) -> Optional[Dict]:
+        results = self.execute(
+            "SELECT version, prices, events FROM pricing_catalog ORDER BY version DESC LIMIT 1", fetch=True
+        )
+        return dict(results[0]) if results else None
+
+    def upsert_suggestions(self, suggestions: List[Dict]) -> set:
+        """Bulk upsert; restituisce le (property_id, date) inserite o cambiate.
+
+        Le righe identiche a quelle salvate non vengono riscritte (niente
+        updated_at né tuple morte per i ricalcoli che non cambiano nulla).
         """
-        
-        schema = """
-        CREATE TABLE IF NOT EXISTS competitors (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            airbnb_id TEXT UNIQUE NOT NULL,
-            url TEXT NOT NULL,
-            active BOOLEAN DEFAULT true,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
+        rows = [
+            (
+                s.get("property_id", DEFAULT_PROPERTY_ID),
+                s["date"],
+                s["suggested_price"],
+                s["base_price"],
+                s["market_avg"],
+                s["event_multiplier"],
+                s["event_name"],
+                psycopg2_extras.Json(s["reasoning"]),
+                s["confidence"],
+            )
+            for s in suggestions
+        ]
+        changed = self.execute_values(
+            "INSERT INTO pricing_suggestions AS s "
+            "(property_id, date, suggested_price, base_price, market_avg, event_multiplier, event_name, "
+            "reasoning, confidence) "
+            "VALUES %s "
+            "ON CONFLICT (property_id, date) DO UPDATE SET "
+            "suggested_price = EXCLUDED.suggested_price, base_price = EXCLUDED.base_price, "
+            "market_avg = EXCLUDED.market_avg, event_multiplier = EXCLUDED.event_multiplier, "
+            "event_name = EXCLUDED.event_name, reasoning = EXCLUDED.reasoning, "
+            "confidence = EXCLUDED.confidence, updated_at = NOW() "
+            "WHERE (s.suggested_price, s.base_price, s.market_avg, s.event_multiplier, s.event_name, "
+            "s.reasoning, s.confidence) IS DISTINCT FROM (EXCLUDED.suggested_price, EXCLUDED.base_price, "
+            "EXCLUDED.market_avg, EXCLUDED.event_multiplier, EXCLUDED.event_name, EXCLUDED.reasoning, "
+            "EXCLUDED.confidence) "
+            "RETURNING property_id, date",
+            rows,
+            fetch=True,
+        )
+        return {(row["property_id"], row["date"]) for row in changed}
+
+    def insert_suggestion_audit(self, rows: List[tuple]):
+        """rows: (computed_at, source, property_id, date, prezzo, base, mercato, evento x, evento,
+        reasoning, confidenza, versione catalogo); un INSERT multi-riga per batch"""
+        self.execute_values(
+            "INSERT INTO suggestion_audit (computed_at, source, property_id, date, suggested_price, "
+            "base_price, market_avg, event_multiplier, event_name, reasoning, confidence, catalog_version) "
+            "VALUES %s",
+            [row[:9] + (psycopg2_extras.Json(row[9]),) + row[10:] for row in rows],
+        )
 
-        CREATE TABLE IF NOT EXISTS price_history (
-            id SERIAL PRIMARY KEY,
-            competitor_id INTEGER REFERENCES competitors(id),
-            date DATE NOT NULL,
-            price DECIMAL(10,2),
-            available BOOLEAN DEFAULT true,
-            scraped_at TIMESTAMP DEFAULT NOW()
-        );
+    def prune_suggestion_audit(self, days: int):
+        self.execute("DELETE FROM suggestion_audit WHERE computed_at < NOW() - %s * INTERVAL '1 day'", (days,))
 
-        CREATE TABLE IF NOT EXISTS events (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            start_date DATE NOT NULL,
-            end_date DATE NOT NULL,
-            category TEXT,
-            impact_score INTEGER,
-            multiplier DECIMAL(5,2),
-            created_at TIMESTAMP DEFAULT NOW(),
-            UNIQUE(name, start_date, end_date)
-        );
+    def get_pushed_prices(self, property_id: int, start: date, end: date) -> Dict[date, float]:
+        results = self.execute(
+            "SELECT date, price FROM channel_push_state WHERE property_id = %s AND date BETWEEN %s AND %s",
+            (property_id, start, end),
+            fetch=True,
+        )
+        return {row["date"]: float(row["price"]) for row in results or []}
 
-        CREATE TABLE IF NOT EXISTS pricing_suggestions (
-            id SERIAL PRIMARY KEY,
-            date DATE UNIQUE NOT NULL,
-            suggested_price DECIMAL(10,2) NOT NULL,
-            base_price DECIMAL(10,2),
-            market_avg DECIMAL(10,2),
-            event_multiplier DECIMAL(5,2),
-            event_name TEXT,
-            reasoning JSONB,
-            confidence DECIMAL(5,2),
-            applied BOOLEAN DEFAULT false,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
+    def save_pushed_prices(self, property_id: int, prices: Dict[date, float]):
+        self.execute_values(
+            "INSERT INTO channel_push_state (property_id, date, price) VALUES %s "
+            "ON CONFLICT (property_id, date) DO UPDATE SET price = EXCLUDED.price, pushed_at = NOW()",
+            [(property_id, day, price) for day, price in prices.items()],
+        )
+
+    def prune_pushed_prices(self, before: date):
+        """Stato push delle date passate (before = oggi a Milano, non CURRENT_DATE del server in UTC)"""
+        self.execute("DELETE FROM channel_push_state WHERE date < %s", (before,))
+
+    def get_suggestions(self, start: date, end: date, property_id: int = DEFAULT_PROPERTY_ID) -> List[Dict]:
+        return self.execute(
+            "SELECT date, suggested_price, base_price, market_avg, event_multiplier, "
+            "event_name, reasoning, confidence "
+            "FROM pricing_suggestions WHERE property_id = %s AND date BETWEEN %s AND %s ORDER BY date",
+            (property_id, start, end),
+            fetch=True,
+        ) or []
+
+    def get_listings(self) -> List[Dict]:
+        """Proprietà attive con config e set competitivo (competitor_ids None = tutti)"""
+        results = self.execute(
+            "SELECT p.id, p.code, p.name, p.config, "
+            "array_agg(pc.competitor_id ORDER BY pc.competitor_id) "
+            "FILTER (WHERE pc.competitor_id IS NOT NULL) AS competitor_ids "
+            "FROM properties p LEFT JOIN property_competitors pc ON pc.property_id = p.id "
+            "WHERE p.active = true GROUP BY p.id ORDER BY p.id",
+            fetch=True,
+        )
+        return [{**row, "config": row["config"] or {}} for row in results or []]
+
+    def get_property_market(self, start: date, end: date, property_ids: List[int]) -> List[Dict]:
+        """Media per giorno sul set competitivo di ciascuna proprietà (ultima osservazione, price_latest)"""
+        return self.execute(
+            "SELECT pc.property_id, l.date, AVG(l.price) AS avg_price "
+            "FROM property_competitors pc JOIN price_latest l ON l.competitor_id = pc.competitor_id "
+            "WHERE pc.property_id = ANY(%s) AND l.date BETWEEN %s AND %s "
+            "AND l.available = true AND l.price > 0 "
+            "GROUP BY pc.property_id, l.date",
+            (property_ids, start, end),
+            fetch=True,
+        ) or []
+
+    def get_competitor_ids(self) -> Dict[str, int]:
+        results = self.execute(
+            "SELECT id, airbnb_id FROM competitors WHERE active = true", fetch=True
+        )
+        return {row["airbnb_id"]: row["id"] for row in results or []}
+
+    def insert_price_history(self, rows: List[tuple]) -> List[date]:
+        """rows: (competitor_id, date, price, available). Restituisce le date cambiate.
+
+        price_latest tiene l'ultima osservazione per (competitor, data) e in
+        price_history entra una riga solo se prezzo o disponibilità sono
+        cambiati. market_daily viene poi ricalcolato per le sole date cambiate
+        da price_latest: una osservazione corrente per competitor, come
+        get_property_market.
+        """
+        # Ultima osservazione vince se il batch contiene duplicati
+        rows = list({(row[0], row[1]): row for row in rows}.values())
+        if not rows:
+            return []
+
+        def work(conn):
+            with conn.cursor() as cur:
+                cur.execute("SELECT ensure_price_history_partition(CURRENT_DATE)")
+                changed = psycopg2_extras.execute_values(
+                    cur,
+                    "WITH batch (competitor_id, date, price, available) AS (VALUES %s), "
+                    "changed AS ("
+                    "  SELECT b.* FROM batch b "
+                    "  LEFT JOIN price_latest l ON l.competitor_id = b.competitor_id AND l.date = b.date "
+                    "  WHERE l.competitor_id IS NULL "
+                    "     OR l.price IS DISTINCT FROM b.price "
+                    "     OR l.available IS DISTINCT FROM b.available"
+                    "), "
+                    "latest AS ("
+                    "  INSERT INTO price_latest (competitor_id, date, price, available) "
+                    "  SELECT competitor_id, date, price, available FROM batch "
+                    "  ON CONFLICT (competitor_id, date) DO UPDATE SET "
+                    "  price = EXCLUDED.price, available = EXCLUDED.available, last_seen_at = NOW()"
+                    "), "
+                    "ins AS ("
+                    "  INSERT INTO price_history (competitor_id, date, price, available) "
+                    "  SELECT competitor_id, date, price, available FROM changed "
+                    "  RETURNING date"
+                    ") "
+                    "SELECT DISTINCT date FROM ins",
+                    rows,
+                    template="(%s::integer, %s::date, %s::numeric, %s::boolean)",
+                    page_size=len(rows),
+                    fetch=True,
+                )
+                dates = sorted(row[0] for row in changed)
+                # Statement successivo: vede price_latest già aggiornata
+                if dates:
+                    self._rebuild_market_daily(cur, dates)
+                return dates
+
+        return self._run(work, "insert_price_history")
+
+    @staticmethod
+    def _rebuild_market_daily(cur, dates: List[date]):
+        """Rollup esatto per le date indicate dall'osservazione corrente di ogni competitor"""
+        cur.execute("DELETE FROM market_daily WHERE date = ANY(%s)", (dates,))
+        cur.execute(
+            "INSERT INTO market_daily (date, n, sum_price, min_price, max_price, median_price) "
+            "SELECT date, COUNT(*), SUM(price), MIN(price), MAX(price), "
+            "percentile_cont(0.5) WITHIN GROUP (ORDER BY price) "
+            "FROM price_latest WHERE date = ANY(%s) AND available = true AND price > 0 "
+            "GROUP BY date",
+            (dates,),
+        )
+
+    def compact_price_history(self, compact_days: int, drop_months: int = 0) -> int:
+        """Retention: oltre compact_days tiene un'osservazione per settimana per
+        (competitor, data); se drop_months > 0 elimina le partizioni mensili più
+        vecchie. Restituisce le righe eliminate.
+
+        market_daily e price_latest non dipendono dalle righe storiche: la
+        compattazione non cambia medie di mercato né suggerimenti.
+        """
+
+        def work(conn):
+            with conn.cursor() as cur:
+                removed = 0
+                if drop_months > 0:
+                    today = today_local()
+                    months = today.year * 12 + today.month - 1 - (drop_months - 1)
+                    cutoff = date(months // 12, months % 12 + 1, 1)
+                    cur.execute(
+                        "SELECT c.relname FROM pg_inherits i "
+                        "JOIN pg_class c ON c.oid = i.inhrelid "
+                        "JOIN pg_class p ON p.oid = i.inhparent "
+                        "WHERE p.relname = 'price_history'"
+                    )
+                    for (name,) in cur.fetchall():
+                        match = re.fullmatch(r"price_history_(\d{4})_(\d{2})", name)
+                        if not match or date(int(match[1]), int(match[2]), 1) >= cutoff:
+                            continue
+                        cur.execute(f'SELECT COUNT(*) FROM "{name}"')
+                        removed += cur.fetchone()[0]
+                        cur.execute(f'DROP TABLE "{name}"')
+                        logger.info(f"Dropped price_history partition {name}")
+
+                cur.execute(
+                    "DELETE FROM price_history p USING ("
+                    "  SELECT id, scraped_at, ROW_NUMBER() OVER ("
+                    "    PARTITION BY competitor_id, date, date_trunc('week', scraped_at) "
+                    "    ORDER BY scraped_at DESC"
+                    "  ) AS rn "
+                    "  FROM price_history WHERE scraped_at < NOW() - %s * INTERVAL '1 day'"
+                    ") old "
+                    "WHERE p.id = old.id AND p.scraped_at = old.scraped_at AND old.rn > 1",
+                    (compact_days,),
+                )
+                return removed + cur.rowcount
+
+        return self._run(work, "compact_price_history")
+
+    def get_market_daily(self, start: date, end: date) -> List[Dict]:
+        return self.execute(
+            "SELECT date, n, sum_price / NULLIF(n, 0) AS avg_price, min_price, max_price, median_price "
+            "FROM market_daily WHERE date BETWEEN %s AND %s",
+            (start, end),
+            fetch=True,
+        ) or []
+
+    def get_forecast_state(self, name: str) -> Optional[Dict]:
+        results = self.execute("SELECT state FROM market_forecast WHERE name = %s", (name,), fetch=True)
+        return results[0]["state"] if results else None
+
+    def save_forecast_state(self, name: str, state: Dict):
+        self.execute(
+            "INSERT INTO market_forecast (name, state) VALUES (%s, %s) "
+            "ON CONFLICT (name) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW()",
+            (name, psycopg2_extras.Json(state)),
+        )
+
+    def get_feed_state(self, url: str) -> Optional[Dict]:
+        results = self.execute(
+            "SELECT etag, last_modified FROM feed_state WHERE url = %s", (url,), fetch=True
+        )
+        return dict(results[0]) if results else None
+
+    def get_seen_feed_entries(self, hashes: List[str]) -> set:
+        if not hashes:
+            return set()
+        results = self.execute(
+            "SELECT entry_hash FROM feed_entries_seen WHERE entry_hash = ANY(%s)", (hashes,), fetch=True
+        )
+        return {row["entry_hash"] for row in results or []}
 
-        CREATE INDEX IF NOT EXISTS idx_price_date ON price_history(date);
-        CREATE INDEX IF NOT EXISTS idx_event_dates ON events(start_date, end_date);
-        CREATE INDEX IF NOT EXISTS idx_suggestions_date ON pricing_suggestions(date);
+    def ingest_feed(self, url: str, etag: Optional[str], last_modified: Optional[str],
+                    hashes: List[str], events: List[Dict]) -> List[Dict]:
+        """Eventi nuovi, entry viste e validatori HTTP del feed in un'unica transazione.
+
+        Restituisce solo gli eventi davvero inseriti: quelli con nome e date di
+        un evento già presente (es. curato a mano) restano come sono.
         """
-        
+
+        def work(conn):
+            inserted = []
+            with conn.cursor(cursor_factory=psycopg2_extras.RealDictCursor) as cur:
+                if events:
+                    inserted = psycopg2_extras.execute_values(
+                        cur,
+                        "INSERT INTO events (name, start_date, end_date, category, impact_score, multiplier) "
+                        # Non sovrascrive eventi curati a mano con gli stessi nome e date
+                        "VALUES %s ON CONFLICT (name, start_date, end_date) DO NOTHING "
+                        "RETURNING name, start_date, end_date, category, impact_score, multiplier",
+                        [self._event_row(e) for e in events],
+                        page_size=len(events),
+                        fetch=True,
+                    )
+                if hashes:
+                    psycopg2_extras.execute_values(
+                        cur,
+                        "INSERT INTO feed_entries_seen (entry_hash, feed_url) VALUES %s ON CONFLICT DO NOTHING",
+                        [(h, url) for h in hashes],
+                    )
+                cur.execute(
+                    "INSERT INTO feed_state (url, etag, last_modified) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (url) DO UPDATE SET etag = EXCLUDED.etag, "
+                    "last_modified = EXCLUDED.last_modified, checked_at = NOW()",
+                    (url, etag, last_modified),
+                )
+            return [dict(row) for row in inserted]
+
+        return self._run(work, "ingest_feed")
+
+    def load_events(self) -> List[Dict]:
+        results = self.execute(
+            "SELECT name, start_date, end_date, category, impact_score, multiplier FROM events",
+            fetch=True,
+        )
+        return [dict(row) for row in results or []]
+
+
+def normalize_event(event: Dict) -> Dict:
+    """Uniforma eventi dal catalogo (start/end/impact) e da tabella events"""
+    start = event.get("start_date", event.get("start"))
+    end = event.get("end_date", event.get("end"))
+    return {
+        "name": event["name"],
+        "start_date": date.fromisoformat(start) if isinstance(start, str) else start,
+        "end_date": date.fromisoformat(end) if isinstance(end, str) else end,
+        "category": event.get("category"),
+        "impact_score": event.get("impact_score", event.get("impact")),
+        "multiplier": event["multiplier"],
+    }
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def event_key(event: Dict) -> tuple:
+    event = normalize_event(event)
+    return (event["name"], event["start_date"], event["end_date"])
+
+
+class CatalogSnapshot:
+    """Versione immutabile di parametri prezzi ed eventi fissi.
+
+    Il motore legge sempre CATALOG.snapshot una volta sola per calcolo: una
+    ricarica sostituisce il riferimento in blocco, mai i contenuti.
+    """
+
+    __slots__ = ("version", "source", "prices", "events")
+
+    def __init__(self, version: int, source: str, prices: Dict, events: List[Dict]):
+        if not isinstance(prices, dict):
+            raise ValueError("prices must be an object")
+        if not isinstance(events, list):
+            raise ValueError("events must be a list")
+        prices = {**PRICES_CONFIG, **prices}
+        for key, value in prices.items():
+            if not is_number(value):
+                raise ValueError(f"prices.{key} must be a number")
+        if prices["MIN_PRICE"] > prices["MAX_PRICE"]:
+            raise ValueError("MIN_PRICE is greater than MAX_PRICE")
+        events = sorted((self.validate_event(i, e) for i, e in enumerate(events)), key=event_key)
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "source", source)
+        object.__setattr__(self, "prices", MappingProxyType(prices))
+        object.__setattr__(self, "events", tuple(MappingProxyType(e) for e in events))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CatalogSnapshot is immutable")
+
+    @staticmethod
+    def validate_event(index: int, event) -> Dict:
+        """Evento del catalogo normalizzato; ValueError se manca un campo o ha un tipo sbagliato"""
+        where = f"events[{index}]"
+        if not isinstance(event, dict):
+            raise ValueError(f"{where} must be an object")
+        if not isinstance(event.get("name"), str) or not event["name"].strip():
+            raise ValueError(f"{where}.name is required")
+        for field in ("start", "end"):
+            value = event.get(f"{field}_date", event.get(field))
+            if not isinstance(value, (str, date)):
+                raise ValueError(f"{where}.{field} must be an ISO date")
         try:
-            self.execute(drop_schema)
-            logger.info("Dropped old schema")
-        except Exception as e:
-            logger.warning(f"Error dropping old schema (ok if first run): {e}")
-        
-        self.execute(schema)
-        logger.info("Database schema initialized")
-
-        # Inserisci competitor
-        for comp in COMPETITORS:
-            self.execute(
-                "INSERT INTO competitors (name, airbnb_id, url) VALUES (%s, %s, %s) "
-                "ON CONFLICT (airbnb_id) DO NOTHING",
-                (comp["name"], comp["airbnb_id"], comp["url"]),
+            event = normalize_event(event)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"{where}: {e}") from None
+        if event["start_date"] > event["end_date"]:
+            raise ValueError(f"{where}: start is after end")
+        if not is_number(event["multiplier"]) or event["multiplier"] <= 0:
+            raise ValueError(f"{where}.multiplier must be a positive number")
+        if event["impact_score"] is not None and not is_number(event["impact_score"]):
+            raise ValueError(f"{where}.impact must be a number")
+        if event["category"] is not None and not isinstance(event["category"], str):
+            raise ValueError(f"{where}.category must be a string")
+        return event
+
+    def same_content(self, other: "CatalogSnapshot") -> bool:
+        return dict(self.prices) == dict(other.prices) and self.events == other.events
+
+    def changed_event_dates(self, other: "CatalogSnapshot") -> tuple:
+        """(eventi tolti o modificati, eventi nuovi o modificati, giorni toccati) rispetto a other"""
+        old = {event_key(e): e for e in other.events}
+        new = {event_key(e): e for e in self.events}
+        removed = [e for key, e in old.items() if new.get(key) != e]
+        added = [e for key, e in new.items() if old.get(key) != e]
+        days = set()
+        for event in removed + added:
+            day = event["start_date"]
+            while day <= event["end_date"]:
+                days.add(day)
+                day += timedelta(days=1)
+        return removed, added, sorted(days)
+
+
+class PricingCatalog:
+    """Catalogo prezzi/eventi ricaricabile: file JSON (PRICING_CATALOG_PATH) o
+    ultima riga di pricing_catalog, altrimenti i valori nel codice.
+
+    Formato: {"prices": {"BASE_WEEKDAY": 85, ...}, "events": [{"name": ...,
+    "start": "2026-04-14", "end": "2026-04-19", "impact": 10, "multiplier": 2.0}]}.
+    Chiavi mancanti: PRICES_CONFIG / FIXED_EVENTS_2026.
+    """
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.snapshot = CatalogSnapshot(0, "default", {}, FIXED_EVENTS_2026)
+        self.mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _read(self, db: Optional[Database]) -> tuple:
+        if self.path:
+            # Registrato anche se il file non è valido: si riprova solo quando cambia
+            self.mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                return json.load(f), f"file {os.path.basename(self.path)}"
+        row = db.get_pricing_catalog() if db is not None else None
+        if row is None:
+            return {}, "default"
+        return row, f"db v{row['version']}"
+
+    def file_changed(self) -> bool:
+        if not self.path:
+            return False
+        try:
+            return os.path.getmtime(self.path) != self.mtime
+        except OSError:
+            return False
+
+    def reload(self, db: Optional[Database] = None) -> tuple:
+        """Legge la sorgente e, se il contenuto è cambiato, pubblica una nuova snapshot.
+
+        Restituisce (vecchia, nuova); sono lo stesso oggetto se non è cambiato
+        nulla. Un catalogo non valido solleva eccezione e lascia quello attuale.
+        """
+        with self._lock:
+            data, source = self._read(db)
+            if not isinstance(data, dict):
+                raise ValueError("catalog must be a JSON object")
+            old = self.snapshot
+            prices, events = data.get("prices"), data.get("events")
+            new = CatalogSnapshot(
+                old.version + 1, source, {} if prices is None else prices,
+                FIXED_EVENTS_2026 if events is None else events,
             )
+            if new.same_content(old):
+                return old, old
+            self.snapshot = new
+        logger.info(f"Pricing catalog v{new.version} loaded from {source}")
+        return old, new
+
+
+CATALOG = PricingCatalog(PRICING_CATALOG_PATH)
 
-        # Inserisci eventi fissi (SENZA colonna source)
-        for event in FIXED_EVENTS_2026:
-            self.execute(
-                "INSERT INTO events (name, start_date, end_date, category, impact_score, multiplier) "
-                "VALUES (%s, %s, %s, %s, %s, %s) "
-                "ON CONFLICT (name, start_date, end_date) DO NOTHING",
-                (
-                    event["name"],
-                    event["start"],
-                    event["end"],
-                    event["category"],
-                    event["impact"],
-                    event["multiplier"],
-                ),
+
+class EventIndex:
+    """Calendario in memoria: per ogni giorno l'evento con impatto maggiore.
+
+    Caricato una volta da tabella events + eventi del catalogo, aggiornato con
+    add() quando si inseriscono eventi; le lookup non toccano il database.
+    Se la lettura della tabella events fallisce l'indice usa i soli eventi del
+    catalogo e la lettura viene ritentata alla prima lookup dopo retry_seconds.
+    """
+
+    def __init__(self, db: Database, retry_seconds: float = 60.0):
+        self.db = db
+        self.retry_seconds = retry_seconds
+        self.version = 0
+        self._lock = threading.Lock()
+        self._events: Optional[Dict[tuple, Dict]] = None
+        self._calendar: Dict[date, Dict] = {}
+        # monotonic del prossimo tentativo sul database; None = eventi DB caricati
+        self._retry_at: Optional[float] = None
+
+    def _ensure_loaded(self):
+        if self._events is None:
+            self.reload()
+            return
+        retry_at = self._retry_at
+        if retry_at is not None and time.monotonic() >= retry_at:
+            with self._lock:
+                # Un solo thread ritenta: gli altri continuano con l'indice attuale
+                if self._retry_at != retry_at:
+                    return
+                self._retry_at = time.monotonic() + self.retry_seconds
+            self.reload()
+
+    def reload(self):
+        """Ricostruisce l'indice da zero (DB + eventi del catalogo)"""
+        try:
+            stored = [normalize_event(e) for e in self.db.load_events()]
+            self._retry_at = None
+        except Exception as e:
+            stored = []
+            self._retry_at = time.monotonic() + self.retry_seconds
+            logger.warning(
+                f"Event index: DB events unavailable, using catalog events only "
+                f"(retry in {self.retry_seconds:.0f}s): {e}"
             )
+        # Snapshot letta dopo il database: all'avvio la query attende il caricamento del catalogo
+        events = [normalize_event(e) for e in CATALOG.snapshot.events] + stored
+        with self._lock:
+            self._rebuild(events, base={})
+        logger.info(f"Event index loaded: {len(self._events)} events, {len(self._calendar)} days")
+
+    def add(self, events: List[Dict]):
+        """Aggiunge eventi all'indice senza ricaricare dal database"""
+        self._ensure_loaded()
+        with self._lock:
+            self._rebuild([normalize_event(e) for e in events])
+
+    def replace(self, removed: List[Dict], added: List[Dict]):
+        """Toglie e aggiunge eventi (ricarica del catalogo) senza rileggere il database"""
+        self._ensure_loaded()
+        gone = {event_key(e) for e in removed}
+        with self._lock:
+            base = {key: e for key, e in self._events.items() if key not in gone}
+            self._rebuild([normalize_event(e) for e in added], base=base)
+
+    def _rebuild(self, new_events: List[Dict], base: Optional[Dict[tuple, Dict]] = None):
+        events = dict(self._events if base is None else base)
+        for event in new_events:
+            events[(event["name"], event["start_date"], event["end_date"])] = event
+        calendar = {}
+        # Stesso ordine della vecchia query: impact_score DESC, vince il primo
+        for event in sorted(events.values(), key=lambda e: -(e["impact_score"] or 0)):
+            day = event["start_date"]
+            while day <= event["end_date"]:
+                calendar.setdefault(day, event)
+                day += timedelta(days=1)
+        # Swap atomico: i lettori vedono il vecchio o il nuovo calendario
+        self._events = events
+        self._calendar = calendar
+        self.version += 1
+
+    def get(self, target_date: date) -> Optional[Dict]:
+        self._ensure_loaded()
+        return self._calendar.get(target_date)
+
+    def get_range(self, start: date, end: date) -> Dict[date, Dict]:
+        self._ensure_loaded()
+        calendar = self._calendar
+        days = (end - start).days + 1
+        result = {}
+        for i in range(days):
+            day = start + timedelta(days=i)
+            event = calendar.get(day)
+            if event:
+                result[day] = event
+        return result
+
+    def between(self, start: date, end: date) -> List[Dict]:
+        """Eventi che si sovrappongono all'intervallo, in ordine di inizio"""
+        self._ensure_loaded()
+        events = [e for e in self._events.values() if e["start_date"] <= end and e["end_date"] >= start]
+        events.sort(key=lambda e: e["start_date"])
+        return events
+
+    def upcoming(self, from_date: date, limit: int = 15) -> List[Dict]:
+        self._ensure_loaded()
+        events = [e for e in self._events.values() if e["end_date"] >= from_date]
+        events.sort(key=lambda e: e["start_date"])
+        return events[:limit]
+
+
+def today_local() -> date:
+    """Data corrente a Milano (il server gira in UTC)"""
+    return datetime.now(ROME_TZ).date()
+
+
+def next_digest_date(now: Optional[datetime] = None) -> date:
+    """Giorno del prossimo report giornaliero (domani se DIGEST_HOUR è già passata)"""
+    now = now or datetime.now(ROME_TZ)
+    return now.date() + timedelta(days=1) if now.hour >= DIGEST_HOUR else now.date()
+
+
+def md_escape(text) -> str:
+    """Testo libero (es. nomi eventi dal feed) per parse_mode="Markdown", fuori da un'entità"""
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+def md_bold(text) -> str:
+    """Grassetto Markdown: dentro l'entità non c'è escape, solo '*' la chiuderebbe"""
+    return "*" + str(text).replace("*", "∗") + "*"
+
+
+CALENDAR_CSV_FIELDS = (
+    "date", "day", "suggested_price", "base_price", "season_multiplier", "dow_multiplier",
+    "event_name", "event_multiplier", "market_avg", "market_forecast", "market_adjustment", "calculated",
+    "confidence", "factors",
+)
 
-        logger.info("Initial data loaded")
+
+def write_calendar_csv(stream, suggestions: List[Dict]):
+    """Una riga per giorno con tutti i fattori del reasoning, scritta riga per riga su stream"""
+    writer = csv.writer(stream)
+    writer.writerow(CALENDAR_CSV_FIELDS)
+    for s in suggestions:
+        reasoning = s["reasoning"] or {}
+        writer.writerow((
+            s["date"].isoformat(),
+            ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"][s["date"].weekday()],
+            f"{s['suggested_price']:.0f}",
+            s["base_price"],
+            reasoning.get("season_multiplier", ""),
+            reasoning.get("dow_multiplier", ""),
+            s["event_name"] or "",
+            s["event_multiplier"] if s["event_multiplier"] is not None else "",
+            s["market_avg"] if s["market_avg"] is not None else "",
+            reasoning.get("market_forecast", ""),
+            reasoning.get("market_adjustment", ""),
+            reasoning.get("calculated", ""),
+            s["confidence"],
+            "; ".join(reasoning.get("factors", [])),
+        ))
+
+
+def ics_text(value: str) -> str:
+    """Escape RFC 5545 per SUMMARY/DESCRIPTION"""
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def ics_line(name: str, value: str) -> str:
+    """Proprietà ICS con folding a 75 ottetti e terminatore CRLF"""
+    line = f"{name}:{value}"
+    if len(line.encode()) <= 75:
+        return line + "\r\n"
+    chunks, chunk = [], ""
+    for char in line:
+        if len((chunk + char).encode()) > (75 if not chunks else 74):
+            chunks.append(chunk)
+            chunk = ""
+        chunk += char
+    chunks.append(chunk)
+    return "\r\n ".join(chunks) + "\r\n"
+
+
+def write_calendar_ics(stream, suggestions: List[Dict], events: List[Dict], property_code: str = "main"):
+    """Feed iCalendar: un evento giornaliero con il prezzo suggerito e uno per ogni evento in calendario"""
+    stamp = datetime.now(ZoneInfo("UTC")).strftime("%Y%m%dT%H%M%SZ")
+    stream.write(
+        "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Milano Express//Pricing Bot//IT\r\n"
+        "CALSCALE:GREGORIAN\r\n"
+    )
+    stream.write(ics_line("X-WR-CALNAME", ics_text(f"Prezzi Milano Express ({property_code})")))
+    for s in suggestions:
+        day = s["date"]
+        summary = f"€{s['suggested_price']:.0f}"
+        if s["event_name"]:
+            summary += f" 🎯 {s['event_name']}"
+        factors = (s["reasoning"] or {}).get("factors", [])
+        stream.write("BEGIN:VEVENT\r\n")
+        stream.write(ics_line("UID", f"price-{property_code}-{day:%Y%m%d}@milano-express"))
+        stream.write(ics_line("DTSTAMP", stamp))
+        stream.write(ics_line("DTSTART;VALUE=DATE", f"{day:%Y%m%d}"))
+        stream.write(ics_line("DTEND;VALUE=DATE", f"{day + timedelta(days=1):%Y%m%d}"))
+        stream.write(ics_line("SUMMARY", ics_text(summary)))
+        if factors:
+            stream.write(ics_line("DESCRIPTION", ics_text("\n".join(factors))))
+        stream.write("TRANSP:TRANSPARENT\r\nEND:VEVENT\r\n")
+    for event in events:
+        key = hashlib.sha1(f"{event['name']}|{event['start_date']}".encode()).hexdigest()[:16]
+        stream.write("BEGIN:VEVENT\r\n")
+        stream.write(ics_line("UID", f"event-{key}@milano-express"))
+        stream.write(ics_line("DTSTAMP", stamp))
+        stream.write(ics_line("DTSTART;VALUE=DATE", f"{event['start_date']:%Y%m%d}"))
+        stream.write(ics_line("DTEND;VALUE=DATE", f"{event['end_date'] + timedelta(days=1):%Y%m%d}"))
+        stream.write(ics_line("SUMMARY", ics_text(f"{event['name']} (x{event['multiplier']})")))
+        if event.get("category"):
+            stream.write(ics_line("CATEGORIES", ics_text(event["category"])))
+        stream.write("TRANSP:TRANSPARENT\r\nEND:VEVENT\r\n")
+    stream.write("END:VCALENDAR\r\n")
+
+
+def calendar_file(write, *args) -> io.BytesIO:
+    """File in memoria (UTF-8) riempito in streaming da write(stream, *args), pronto per l'invio"""
+    buffer = io.BytesIO()
+    stream = io.TextIOWrapper(buffer, encoding="utf-8", newline="")
+    write(stream, *args)
+    stream.flush()
+    stream.detach()
+    buffer.seek(0)
+    return buffer
+
+
+class ResponseCache:
+    """LRU limitata di risposte renderizzate.
+
+    Le chiavi includono data locale e versione dei dati: a mezzanotte
+    (Europe/Rome) o dopo una scrittura di eventi/prezzi le vecchie voci non
+    vengono più lette ed escono per LRU.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: str):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def build_http_session(pool_size: int = 10, retries: int = 3) -> requests.Session:
+    """Sessione HTTP condivisa: keep-alive, pool connessioni e retry con backoff"""
+    session = requests.Session()
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=1.0,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD", "POST", "PUT"),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostRateLimiter:
+    """Intervallo minimo (con jitter) tra richieste verso lo stesso host, thread-safe"""
+
+    def __init__(self, min_interval: float, jitter: float = 0.0):
+        self.min_interval = min_interval
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self._next_slot: Dict[str, float] = {}
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval + random.uniform(0, self.jitter)
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def parse_price(text) -> Optional[float]:
+    """'€ 1.234,50' / '€120' / 120 -> float"""
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return float(text)
+    digits = re.sub(r"[^\d,.]", "", str(text))
+    if not digits:
+        return None
+    if "," in digits:
+        digits = digits.replace(".", "").replace(",", ".")
+    elif re.fullmatch(r"\d{1,3}(\.\d{3})+", digits):
+        digits = digits.replace(".", "")
+    try:
+        return float(digits)
+    except ValueError:
+        return None
+
+
+class CompetitorScraper:
+    """Scarica in parallelo i calendari competitor e li salva in price_history"""
+
+    def __init__(
+        self,
+        db: Database,
+        session: Optional[requests.Session] = None,
+        url_template: str = SCRAPER_CALENDAR_URL,
+        workers: int = SCRAPER_WORKERS,
+        rate_limiter: Optional[HostRateLimiter] = None,
+    ):
+        self.db = db
+        self.url_template = url_template
+        self.workers = workers
+        self.session = session or build_http_session(pool_size=workers)
+        self.rate_limiter = rate_limiter or HostRateLimiter(SCRAPER_MIN_INTERVAL, SCRAPER_JITTER)
+
+    def fetch(self, competitor: Dict) -> str:
+        url = self.url_template.format(**competitor)
+        self.rate_limiter.wait(url)
+        response = self.session.get(
+            url,
+            headers={"User-Agent": SCRAPER_USER_AGENT, "Accept-Language": "it-IT,it;q=0.9"},
+            timeout=30,
+        )
+        response.raise_for_status()
+        return response.text
+
+    @staticmethod
+    def parse_calendar(html: str) -> List[tuple]:
+        """Estrae (date, price, available) dalla pagina calendario"""
+        soup = bs4.BeautifulSoup(html, "lxml")
+        days: Dict[date, tuple] = {}
+
+        # 1) Stato JSON incorporato (calendarMonths -> days)
+        def walk(node):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    if key == "calendarMonths" and isinstance(value, list):
+                        for month in value:
+                            for day in (month or {}).get("days", []):
+                                try:
+                                    day_date = date.fromisoformat(day["calendarDate"])
+                                except (KeyError, TypeError, ValueError):
+                                    continue
+                                price = day.get("price") or {}
+                                if isinstance(price, dict):
+                                    price = price.get("localPriceFormatted") or price.get("amount")
+                                days[day_date] = (day_date, parse_price(price), bool(day.get("available")))
+                    else:
+                        walk(value)
+            elif isinstance(node, list):
+                for item in node:
+                    walk(item)
+
+        for script in soup.find_all("script", attrs={"type": "application/json"}):
+            try:
+                walk(json.loads(script.string or ""))
+            except ValueError:
+                continue
+
+        # 2) Celle del calendario renderizzato (data-testid="calendar-day-DD/MM/YYYY")
+        if not days:
+            for cell in soup.select('[data-testid^="calendar-day-"]'):
+                try:
+                    day_date = datetime.strptime(cell["data-testid"][len("calendar-day-"):], "%d/%m/%Y").date()
+                except ValueError:
+                    continue
+                available = cell.get("data-is-day-blocked", "false") != "true"
+                price = parse_price(cell.get("data-price") or cell.get_text(" ", strip=True).split(" ")[-1])
+                days[day_date] = (day_date, price, available)
+
+        return [days[d] for d in sorted(days)]
+
+    def _scrape_one(self, competitor: Dict) -> List[tuple]:
+        try:
+            rows = self.parse_calendar(self.fetch(competitor))
+            logger.info(f"Scraped {competitor['name']}: {len(rows)} days")
+            return rows
+        except Exception as e:
+            logger.error(f"Error scraping {competitor['name']}: {e}")
+            return []
+
+    def scrape_all(self, competitors: List[Dict] = COMPETITORS) -> List[date]:
+        """Scrape concorrente di tutti i competitor; restituisce le date con prezzi cambiati"""
+        ids = self.db.get_competitor_ids()
+        competitors = [c for c in competitors if c["airbnb_id"] in ids]
+        if not competitors:
+            return []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            calendars = list(pool.map(self._scrape_one, competitors))
+        rows = [
+            (ids[competitor["airbnb_id"]], day, price, available)
+            for competitor, calendar in zip(competitors, calendars)
+            for day, price, available in calendar
+        ]
+        changed = self.db.insert_price_history(rows)
+        logger.info(
+            f"Scraped {len(rows)} days from {len(competitors)} competitors, {len(changed)} dates changed"
+        )
+        return changed
+
+
+MONTHS = {
+    "gennaio": 1, "febbraio": 2, "marzo": 3, "aprile": 4, "maggio": 5, "giugno": 6,
+    "luglio": 7, "agosto": 8, "settembre": 9, "ottobre": 10, "novembre": 11, "dicembre": 12,
+    "gen": 1, "feb": 2, "mar": 3, "apr": 4, "mag": 5, "giu": 6,
+    "lug": 7, "ago": 8, "set": 9, "ott": 10, "nov": 11, "dic": 12,
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6,
+    "july": 7, "august": 8, "september": 9, "october": 10, "november": 11, "december": 12,
+}
+_MONTH = "(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?"
+_SEP = r"\s*(?:-|–|/|al|a|to|e)\s*"
+DATE_RANGE_PATTERNS = [
+    # 21/04/2026 - 26/04/2026
+    ("numeric", re.compile(
+        r"(\d{1,2})[/.](\d{1,2})[/.](\d{4})" + _SEP + r"(\d{1,2})[/.](\d{1,2})[/.](\d{4})"
+    )),
+    # 28 aprile - 3 maggio 2026
+    ("months", re.compile(
+        r"(\d{1,2})\s+" + _MONTH + r"(?:\s+(\d{4}))?" + _SEP + r"(\d{1,2})\s+" + _MONTH + r"(?:\s+(\d{4}))?",
+        re.I,
+    )),
+    # dal 21 al 26 aprile 2026 / 21-26 aprile 2026
+    ("month", re.compile(r"(\d{1,2})" + _SEP + r"(\d{1,2})\s+" + _MONTH + r"(?:\s+(\d{4}))?", re.I)),
+]
+
+
+def extract_date_range(text: str, default_year: int) -> Optional[tuple]:
+    """Primo intervallo di date (start, end) trovato nel testo di una entry RSS.
+
+    Solo intervalli espliciti: una data singola nel testo è spesso quella di
+    pubblicazione o di una conferenza stampa, non le date della fiera.
+    """
+    text = re.sub(r"<[^>]+>", " ", text or "")
+    for kind, pattern in DATE_RANGE_PATTERNS:
+        for match in pattern.finditer(text):
+            g = match.groups()
+            try:
+                if kind == "numeric":
+                    start = date(int(g[2]), int(g[1]), int(g[0]))
+                    end = date(int(g[5]), int(g[4]), int(g[3]))
+                elif kind == "months":
+                    end_year = int(g[5] or g[2] or default_year)
+                    start_year = int(g[2]) if g[2] else end_year - (MONTHS[g[1].lower()] > MONTHS[g[4].lower()])
+                    start = date(start_year, MONTHS[g[1].lower()], int(g[0]))
+                    end = date(end_year, MONTHS[g[4].lower()], int(g[3]))
+                else:
+                    year, month = int(g[3] or default_year), MONTHS[g[2].lower()]
+                    start, end = date(year, month, int(g[0])), date(year, month, int(g[1]))
+            except ValueError:
+                continue
+            if start <= end <= start + timedelta(days=60):
+                return start, end
+    return None
 
 
 class EventFetcher:
-    """Fetch eventi da fonti esterne (opzionale)"""
+    """Ingestione incrementale eventi da feed RSS (GET condizionali, entry già viste saltate)"""
 
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, session: Optional[requests.Session] = None, feed_url: str = EVENT_FEED_URL):
         self.db = db
+        self.feed_url = feed_url
+        self.session = session or build_http_session(pool_size=1)
+
+    @staticmethod
+    def entry_key(entry: Dict) -> str:
+        ident = entry.get("id") or entry.get("link") or entry.get("title", "")
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def fetch(self, state: Optional[Dict]) -> Optional[requests.Response]:
+        """GET condizionale (ETag/Last-Modified): None se il feed non è cambiato"""
+        headers = {"User-Agent": SCRAPER_USER_AGENT}
+        if state and state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state and state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        response = self.session.get(self.feed_url, headers=headers, timeout=30)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def entry_to_event(entry: Dict, default_year: int) -> Optional[Dict]:
+        text = f"{entry.get('title', '')} {entry.get('summary', '')}"
+        dates = extract_date_range(text, default_year)
+        if not dates or not entry.get("title"):
+            return None
+        return {
+            "name": entry["title"].strip()[:200],
+            "start_date": dates[0],
+            "end_date": dates[1],
+            "category": "fiera",
+            "impact_score": EVENT_FEED_IMPACT,
+            "multiplier": EVENT_FEED_MULTIPLIER,
+        }
 
-    def fetch_fieramilano_rss(self) -> List[Dict]:
-        """Legge RSS Fiera Milano"""
-        try:
-            feed_url = "https://www.fieramilano.it/feed"
-            feed = feedparser.parse(feed_url)
-
-            events = []
-            for entry in feed.entries[:10]:
-                event = {
-                    "name": entry.title,
-                    "description": entry.get("summary", ""),
-                    "link": entry.link,
-                    "category": "fiera",
-                }
+    def update_events_from_sources(self) -> List[Dict]:
+        """Scarica il feed se cambiato e salva (bulk insert) solo gli eventi nuovi; restituisce gli inseriti"""
+        state = self.db.get_feed_state(self.feed_url)
+        response = self.fetch(state)
+        if response is None:
+            logger.info("Event feed not modified")
+            return []
+
+        feed = feedparser.parse(response.content)
+        entries = {self.entry_key(entry): entry for entry in feed.entries}
+        seen = self.db.get_seen_feed_entries(list(entries))
+        default_year = today_local().year
+        events = []
+        for key, entry in entries.items():
+            if key in seen:
+                continue
+            event = self.entry_to_event(entry, default_year)
+            if event:
                 events.append(event)
-                logger.info(f"RSS Fiera Milano: {entry.title}")
 
-            return events
-        except Exception as e:
-            logger.error(f"Error fetching Fiera Milano RSS: {e}")
-            return []
+        inserted = self.db.ingest_feed(
+            self.feed_url,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            [key for key in entries if key not in seen],
+            events,
+        )
+        logger.info(
+            f"Event feed: {len(entries)} entries, {len(entries) - len(seen)} new, "
+            f"{len(events)} events parsed, {len(inserted)} saved"
+        )
+        # Solo gli eventi inseriti: un evento già presente (curato) non va sovrascritto nell'indice
+        return inserted
+
+
+def season_multiplier(month: int) -> float:
+    """Stagionalità calibrata su mercato reale"""
+    # Estate: competitor NON alzano molto (€113 vs €122 inverno!)
+    if month in [6, 7, 8]:
+        return 1.05  # Era 1.2, ora realistico
+    if month in [4, 5, 9, 10]:
+        return 1.1
+    if month in [12, 1, 2]:
+        return 1.0
+    return 1.0
+
+
+@functools.lru_cache(maxsize=None)
+def season_table():
+    """Array NumPy dei moltiplicatori stagionali; indice 0 inutilizzato: season_table()[mese]"""
+    return np.array([1.0] + [season_multiplier(m) for m in range(1, 13)])
+
+
+def price_kernel(
+    dates, event_multipliers, market_avgs, config: Optional[Dict] = None, market_forecasts=None
+) -> Dict[str, np.ndarray]:
+    """Versione vettoriale di price_for_date.
+
+    dates: array datetime64[D]; event_multipliers, market_avgs e
+    market_forecasts: float, NaN dove non c'è evento / dato di mercato /
+    previsione. Stesso ordine delle operazioni del calcolo scalare, quindi
+    risultati identici bit per bit.
+    """
+    config = config or CATALOG.snapshot.prices
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    event = np.asarray(event_multipliers, dtype=np.float64) * config.get("EVENT_SCALE", 1.0)
+    market = np.asarray(market_avgs, dtype=np.float64)
+    if market_forecasts is None:
+        forecast = np.full(market.shape, np.nan)
+    else:
+        forecast = np.asarray(market_forecasts, dtype=np.float64)
+
+    # 1970-01-01 era giovedì (weekday 3)
+    dow = (dates.astype(np.int64) + 3) % 7
+    month = dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    weekend = (dow == 4) | (dow == 5)
+
+    base = np.where(weekend, float(config["BASE_WEEKEND"]), float(config["BASE_WEEKDAY"]))
+    has_event = ~np.isnan(event)
+    event_mult = np.where(has_event, event, 1.0)
+    season_mult = season_table()[month]
+    dow_mult = np.where(
+        weekend, config["WEEKEND_MULTIPLIER"], np.where(dow == 6, config["SUNDAY_DISCOUNT"], 1.0)
+    )
+    has_market = ~np.isnan(market) & (market != 0)
+    # La previsione conta solo dove manca il dato osservato
+    has_forecast = ~has_market & ~np.isnan(forecast) & (forecast != 0)
+    reference = np.where(has_market, market, np.where(has_forecast, forecast, 0.0))
+    market_adj = np.where(has_market | has_forecast, (reference - base) * 0.3, 0.0)
+
+    calculated = (base + market_adj) * event_mult * season_mult * dow_mult
+    final = np.maximum(config["MIN_PRICE"], np.minimum(config["MAX_PRICE"], calculated))
+    market_weight = np.where(has_market, 0.15, np.where(has_forecast, MARKET_FORECAST_CONFIDENCE, 0.0))
+    confidence = 0.75 + market_weight + np.where(has_event, 0.1, 0.0)
+
+    return {
+        "base_price": base,
+        "event_multiplier": event_mult,
+        "has_event": has_event,
+        "season_multiplier": season_mult,
+        "dow_multiplier": dow_mult,
+        "market_avg": market,
+        "has_market": has_market,
+        "market_forecast": forecast,
+        "has_forecast": has_forecast,
+        "market_adjustment": market_adj,
+        "calculated": calculated,
+        "suggested_price": np.round(final),
+        "confidence": np.minimum(np.round(confidence, 2), 1.0),
+    }
+
+
+def dow_multiplier(dow: int, config: Dict) -> float:
+    if dow in [4, 5]:
+        return config["WEEKEND_MULTIPLIER"]
+    if dow == 6:
+        return config["SUNDAY_DISCOUNT"]
+    return 1.0
+
+
+def price_for_date(
+    target_date: date,
+    event: Optional[Dict],
+    market_avg: Optional[float],
+    config: Dict,
+    forecast: Optional[float] = None,
+) -> Dict:
+    """Prezzo suggerito e reasoning per un giorno (formula scalare di riferimento).
+
+    forecast: media di mercato prevista (MarketForecast), usata solo se manca
+    quella osservata, con peso di confidenza MARKET_FORECAST_CONFIDENCE.
+    """
+    dow = target_date.weekday()
+    base_price = config["BASE_WEEKEND"] if dow in [4, 5] else config["BASE_WEEKDAY"]
+
+    reasoning = {"base_price": base_price, "factors": []}
+
+    # Eventi
+    event_mult = 1.0
+    if event:
+        event_mult = float(event["multiplier"]) * config.get("EVENT_SCALE", 1.0)
+        reasoning["event"] = {"name": event["name"], "multiplier": event_mult}
+        reasoning["factors"].append(f"Evento: {event['name']} (x{event_mult})")
+
+    # Stagionalità
+    season_mult = season_multiplier(target_date.month)
+    reasoning["season_multiplier"] = season_mult
+    if season_mult != 1.0:
+        reasoning["factors"].append(f"Stagione (x{season_mult})")
+
+    # Giorno settimana
+    dow_mult = dow_multiplier(dow, config)
+    reasoning["dow_multiplier"] = dow_mult
+    if dow_mult != 1.0:
+        day_name = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"][dow]
+        reasoning["factors"].append(f"Giorno: {day_name} (x{dow_mult})")
+
+    # Mercato (opzionale se disponibile)
+    market_adj = 0.0
+    if market_avg:
+        market_adj = (market_avg - base_price) * 0.3
+        reasoning["market_avg"] = market_avg
+        reasoning["market_adjustment"] = round(market_adj, 2)
+        reasoning["factors"].append(f"Mercato: €{market_avg:.0f} (adj: €{market_adj:+.0f})")
+    elif forecast:
+        market_adj = (forecast - base_price) * 0.3
+        reasoning["market_forecast"] = forecast
+        reasoning["market_adjustment"] = round(market_adj, 2)
+        reasoning["factors"].append(f"Mercato previsto: €{forecast:.0f} (adj: €{market_adj:+.0f})")
+
+    calculated_price = (base_price + market_adj) * event_mult * season_mult * dow_mult
+    final_price = max(config["MIN_PRICE"], min(config["MAX_PRICE"], calculated_price))
+
+    reasoning["calculated"] = round(calculated_price, 2)
+    reasoning["final"] = round(final_price, 0)
+
+    confidence = 0.75  # Base confidence
+    if market_avg:
+        confidence += 0.15
+    elif forecast:
+        confidence += MARKET_FORECAST_CONFIDENCE
+    if event:
+        confidence += 0.1
+
+    return {
+        "date": target_date,
+        "suggested_price": round(final_price, 0),
+        "base_price": base_price,
+        "market_avg": market_avg,
+        "event_multiplier": event_mult if event else None,
+        "event_name": event["name"] if event else None,
+        "reasoning": reasoning,
+        "confidence": min(round(confidence, 2), 1.0),
+    }
+
+
+def price_range(
+    start: date,
+    end: date,
+    events: Dict[date, Dict],
+    market: Dict[date, float],
+    config: Dict,
+    forecasts: Optional[Dict[date, float]] = None,
+) -> List[Dict]:
+    """price_for_date su ogni giorno tra start e end (inclusi)"""
+    forecasts = forecasts or {}
+    return [
+        price_for_date(day, events.get(day), market.get(day), config, forecasts.get(day))
+        for day in (start + timedelta(days=i) for i in range((end - start).days + 1))
+    ]
+
+
+def suggestion_window(
+    start: Optional[date] = None, end: Optional[date] = None, dates: Optional[List[date]] = None
+) -> Optional[tuple]:
+    """(start, end, date richieste o None) limitati all'orizzonte SUGGESTION_HORIZON_DAYS"""
+    today = today_local()
+    horizon_end = today + timedelta(days=SUGGESTION_HORIZON_DAYS - 1)
+    if dates is not None:
+        wanted = {d for d in dates if today <= d <= horizon_end}
+        if not wanted:
+            return None
+        return min(wanted), max(wanted), wanted
+    start = max(start or today, today)
+    end = min(end or horizon_end, horizon_end)
+    return (start, end, None) if start <= end else None
+
+
+class MarketForecast:
+    """Previsione online della media di mercato per le date senza dati competitor.
+
+    Smoothing esponenziale moltiplicativo (Holt-Winters senza trend):
+    previsione = livello × fattore giorno settimana × fattore mese. La serie
+    sono le medie market_daily dei giorni già passati, osservate una volta
+    sola e in ordine di data (last_date nello stato). Lo stato (pochi numeri)
+    è salvato in market_forecast e ricaricato al riavvio, senza rileggere lo
+    storico; ogni aggiornamento sostituisce lo stato con una copia nuova, così
+    predict() legge sempre uno stato coerente senza lock.
+
+    Con property_id la serie è la media sul set competitivo della proprietà
+    (get_property_market) invece del rollup di tutti i competitor.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        name: str = "market",
+        alpha: float = MARKET_FORECAST_ALPHA,
+        gamma: float = MARKET_FORECAST_GAMMA,
+        min_obs: int = MARKET_FORECAST_MIN_OBS,
+        property_id: Optional[int] = None,
+    ):
+        self.db = db
+        self.name = name
+        self.alpha = alpha
+        self.gamma = gamma
+        self.min_obs = min_obs
+        self.property_id = property_id
+        self._lock = threading.Lock()
+        self.state: Optional[Dict] = None
+
+    @classmethod
+    def for_listing(cls, db: Database, listing: Dict) -> "MarketForecast":
+        """Previsione sul set competitivo della proprietà (None = tutti i competitor)"""
+        ids = listing.get("competitor_ids")
+        if not ids:
+            return cls(db)
+        # Il nome cambia con il set: uno stato addestrato su altri competitor non si riusa
+        digest = hashlib.sha1(",".join(map(str, sorted(ids))).encode()).hexdigest()[:8]
+        return cls(db, f"property-{listing['id']}-{digest}", property_id=listing["id"])
+
+    @staticmethod
+    def empty_state() -> Dict:
+        return {"level": None, "weekday": [1.0] * 7, "month": [1.0] * 12, "n": 0, "last_date": None}
+
+    def _ensure_loaded(self):
+        if self.state is not None:
+            return
+        with self._lock:
+            if self.state is not None:
+                return
+            try:
+                state = self.db.get_forecast_state(self.name)
+            except Exception as e:
+                logger.warning(f"Market forecast: starting from scratch ({e})")
+                self.state = self.empty_state()
+                return
+            if state is None or "last_date" not in state:
+                # Primo avvio (o stato senza last_date): addestramento sull'ultimo anno
+                self.state = self.empty_state()
+                count = self._update_locked()
+                logger.info(f"Market forecast {self.name} bootstrapped from {count} days")
+            else:
+                self.state = state
 
-    def update_events_from_sources(self):
-        """Aggiorna eventi da RSS (opzionale)"""
-        logger.info("Checking for new events from RSS...")
-        rss_events = self.fetch_fieramilano_rss()
-        logger.info(f"Found {len(rss_events)} events from RSS")
+    def _history(self, start: date, end: date) -> Dict[date, float]:
+        if self.property_id is None:
+            rows = self.db.get_market_daily(start, end)
+        else:
+            rows = self.db.get_property_market(start, end, [self.property_id])
+        return {row["date"]: float(row["avg_price"]) for row in rows if row["avg_price"]}
+
+    def _observe_all(self, state: Dict, observations: Dict[date, float]) -> Dict:
+        """Nuovo stato con le osservazioni applicate in ordine di data (state non viene modificato)"""
+        state = {**state, "weekday": list(state["weekday"]), "month": list(state["month"])}
+        for day in sorted(observations):
+            price = observations[day]
+            dow, month = day.weekday(), day.month - 1
+            weekday, season = state["weekday"][dow], state["month"][month]
+            if state["level"] is None:
+                state["level"] = price / (weekday * season)
+            else:
+                state["level"] += self.alpha * (price / (weekday * season) - state["level"])
+            level = state["level"]
+            state["weekday"][dow] = weekday + self.gamma * (price / (level * season) - weekday)
+            state["month"][month] = season + self.gamma * (price / (level * state["weekday"][dow]) - season)
+            state["n"] += 1
+            state["last_date"] = day.isoformat()
+        return state
+
+    def _update_locked(self) -> int:
+        yesterday = today_local() - timedelta(days=1)
+        last = self.state.get("last_date")
+        start = date.fromisoformat(last) + timedelta(days=1) if last else yesterday - timedelta(days=364)
+        if start > yesterday:
+            return 0
+        observations = self._history(start, yesterday)
+        if not observations:
+            return 0
+        self.state = self._observe_all(self.state, observations)
+        self.db.save_forecast_state(self.name, self.state)
+        return len(observations)
+
+    def update(self) -> int:
+        """Dopo uno scraping: osserva le medie dei giorni conclusi dopo last_date, una volta sola"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._update_locked()
+
+    @staticmethod
+    def _predict(state: Dict, day: date) -> float:
+        return round(state["level"] * state["weekday"][day.weekday()] * state["month"][day.month - 1], 2)
+
+    def _ready_state(self) -> Optional[Dict]:
+        self._ensure_loaded()
+        state = self.state
+        if state["n"] < self.min_obs or state["level"] is None:
+            return None
+        return state
+
+    def predict(self, day: date) -> Optional[float]:
+        state = self._ready_state()
+        return None if state is None else self._predict(state, day)
+
+    def fill(self, start: date, end: date, observed: Dict[date, float]) -> Dict[date, float]:
+        """Previsioni per i giorni dell'intervallo senza media osservata"""
+        state = self._ready_state()
+        if state is None:
+            return {}
+        forecasts = {}
+        for i in range((end - start).days + 1):
+            day = start + timedelta(days=i)
+            if day not in observed:
+                forecasts[day] = self._predict(state, day)
+        return forecasts
+
+
+class SuggestionAudit:
+    """Registro append-only (suggestion_audit) dei suggerimenti calcolati e serviti, in write-behind.
+
+    record() accoda in memoria e ritorna subito; un thread scrive in batch
+    multi-riga quando la coda arriva a batch_size o ogni flush_seconds.
+    close() svuota la coda allo shutdown. Se il database non risponde la coda
+    è limitata a max_pending righe (si scartano le più vecchie) e i tentativi
+    successivi aspettano un backoff esponenziale fino a max_backoff secondi,
+    che i nuovi record() non accorciano.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_seconds: float = AUDIT_FLUSH_SECONDS,
+        max_pending: int = AUDIT_MAX_PENDING,
+        max_backoff: float = 300.0,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self._failures = 0
+        self._retry_at = 0.0
+        self._pending: List[tuple] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def record(self, suggestions: List[Dict], source: str, property_id: int = DEFAULT_PROPERTY_ID):
+        now = datetime.now(ROME_TZ)
+        version = CATALOG.snapshot.version
+        rows = [
+            (
+                now, source, property_id, s["date"], s["suggested_price"], s["base_price"], s["market_avg"],
+                s["event_multiplier"], s["event_name"], s["reasoning"], s["confidence"], version,
+            )
+            for s in suggestions
+        ]
+        with self._cond:
+            if self._closed:
+                return
+            self._pending.extend(rows)
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+                METRICS.inc("suggestion_audit_rows_total", overflow, result="dropped")
+            METRICS.set("suggestion_audit_pending", len(self._pending))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="suggestion-audit", daemon=True)
+                self._thread.start()
+            elif len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _ready(self) -> bool:
+        # Durante il backoff una coda piena non anticipa il tentativo: solo close() lo fa
+        return self._closed or (len(self._pending) >= self.batch_size and time.monotonic() >= self._retry_at)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    self._ready, timeout=max(self.flush_seconds, self._retry_at - time.monotonic())
+                )
+                batch, self._pending = self._pending, []
+                closed = self._closed
+                METRICS.set("suggestion_audit_pending", 0)
+            if batch and self._write(batch):
+                with self._cond:
+                    self._failures, self._retry_at = 0, 0.0
+            elif batch and not closed:
+                with self._cond:
+                    # Rimette in coda (prima delle nuove) e riprova dopo il backoff
+                    self._pending[:0] = batch[-self.max_pending:]
+                    del self._pending[self.max_pending:]
+                    METRICS.set("suggestion_audit_pending", len(self._pending))
+                    self._failures += 1
+                    delay = min(self.flush_seconds * 2 ** (self._failures - 1), self.max_backoff)
+                    self._retry_at = time.monotonic() + delay
+            if closed:
+                return
+
+    def _write(self, batch: List[tuple]) -> bool:
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            try:
+                self.db.insert_suggestion_audit(chunk)
+            except Exception as e:
+                METRICS.inc("suggestion_audit_rows_total", len(batch) - start, result="failed")
+                logger.warning(f"Suggestion audit flush failed ({len(batch) - start} rows): {e}")
+                del batch[:start]
+                return False
+            METRICS.inc("suggestion_audit_rows_total", len(chunk), result="written")
+        return True
+
+    def close(self, timeout: float = 10.0):
+        """Shutdown: scrive le righe in coda e ferma il thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
 
 
 class PricingEngine:
-    def __init__(self, db: Database):
+    """Pricing di una proprietà (default: Milano Express, catalogo prezzi e tutti i competitor)"""
+
+    def __init__(
+        self,
+        db: Database,
+        events: Optional[EventIndex] = None,
+        listing: Optional[Dict] = None,
+        forecast: Optional[MarketForecast] = None,
+        audit: Optional[SuggestionAudit] = None,
+    ):
         self.db = db
+        self.events = events or EventIndex(db)
+        self.listing = listing or DEFAULT_LISTING
+        self.forecast = forecast or MarketForecast.for_listing(db, self.listing)
+        self.audit = audit
+        # Incrementata a ogni scrittura di suggerimenti/prezzi (vedi ResponseCache)
+        self.version = 0
+
+    @property
+    def property_id(self) -> int:
+        return self.listing["id"]
+
+    @property
+    def config(self) -> Dict:
+        return self.config_for(CATALOG.snapshot)
+
+    def config_for(self, snapshot: CatalogSnapshot) -> Dict:
+        """Parametri effettivi: catalogo sovrascritto dalla config della proprietà"""
+        return {**snapshot.prices, **(self.listing.get("config") or {})}
+
+    def get_suggestions(self, start: date, end: date, source: Optional[str] = None) -> List[Dict]:
+        """Suggerimenti precalcolati; i giorni mancanti vengono calcolati al volo.
+
+        Con source (comando, digest, ...) i suggerimenti serviti finiscono
+        nell'audit in write-behind, fuori dal percorso della risposta.
+        """
+        stored = {
+            row["date"]: self._suggestion_from_row(row)
+            for row in self.db.get_suggestions(start, end, self.property_id)
+        }
+        missing = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        missing = [d for d in missing if d not in stored]
+        METRICS.record_cache("suggestions", hit=len(stored), miss=len(missing))
+        if missing:
+            for result in self.calculate_price_range(min(missing), max(missing)):
+                stored.setdefault(result["date"], result)
+        suggestions = [stored[d] for d in sorted(stored) if start <= d <= end]
+        if source and self.audit is not None:
+            self.audit.record(suggestions, source, self.property_id)
+        return suggestions
+
+    @staticmethod
+    def _suggestion_from_row(row: Dict) -> Dict:
+        def _float(value):
+            return float(value) if value is not None else None
+
+        return {
+            "date": row["date"],
+            "suggested_price": float(row["suggested_price"]),
+            "base_price": _float(row["base_price"]),
+            "market_avg": _float(row["market_avg"]),
+            "event_multiplier": _float(row["event_multiplier"]),
+            "event_name": row["event_name"],
+            "reasoning": row["reasoning"] or {"factors": []},
+            "confidence": float(row["confidence"]),
+        }
+
+    def get_events_for_range(self, start: date, end: date) -> Dict[date, Dict]:
+        """Evento con impatto maggiore per ogni giorno dell'intervallo (da indice)"""
+        return self.events.get_range(start, end)
 
     def get_event_for_date(self, target_date: date) -> Optional[Dict]:
-        results = self.db.execute(
-            "SELECT name, category, impact_score, multiplier "
-            "FROM events "
-            "WHERE %s BETWEEN start_date AND end_date "
-            "ORDER BY impact_score DESC LIMIT 1",
-            (target_date,),
-            fetch=True,
-        )
-        return dict(results[0]) if results else None
+        return self.events.get(target_date)
 
     def get_season_multiplier(self, target_date: date) -> float:
-        """Stagionalità calibrata su mercato reale"""
-        month = target_date.month
-        # Estate: competitor NON alzano molto (€113 vs €122 inverno!)
-        if month in [6, 7, 8]:
-            return 1.05  # Era 1.2, ora realistico
-        if month in [4, 5, 9, 10]:
-            return 1.1
-        if month in [12, 1, 2]:
-            return 1.0
-        return 1.0
+        return season_multiplier(target_date.month)
 
     def get_dow_multiplier(self, target_date: date) -> float:
-        dow = target_date.weekday()
-        if dow in [4, 5]:
-            return PRICES_CONFIG["WEEKEND_MULTIPLIER"]
-        if dow == 6:
-            return PRICES_CONFIG["SUNDAY_DISCOUNT"]
-        return 1.0
+        return dow_multiplier(target_date.weekday(), self.config)
+
+    def get_market_averages(self, start: date, end: date) -> Dict[date, float]:
+        """Media prezzi competitor per ogni giorno: rollup market_daily, o il set competitivo della proprietà"""
+        if self.listing.get("competitor_ids"):
+            rows = self.db.get_property_market(start, end, [self.property_id])
+        else:
+            rows = self.db.get_market_daily(start, end)
+        return {row["date"]: float(row["avg_price"]) for row in rows if row["avg_price"]}
 
     def get_market_average(self, target_date: date) -> Optional[float]:
-        results = self.db.execute(
-            "SELECT AVG(price) as avg_price "
-            "FROM price_history "
-            "WHERE date = %s AND available = true AND price > 0",
-            (target_date,),
-            fetch=True,
+        return self.get_market_averages(target_date, target_date).get(target_date)
+
+    def calculate_price_range(self, start: date, end: date) -> List[Dict]:
+        """Prezzi per ogni giorno tra start e end (inclusi) con query costanti"""
+        if end < start:
+            return []
+        events = self.get_events_for_range(start, end)
+        market = self.get_market_averages(start, end)
+        forecasts = self.forecast.fill(start, end, market)
+        return price_range(start, end, events, market, self.config, forecasts)
+
+    def calculate_price_arrays(self, start: date, end: date) -> Dict[str, np.ndarray]:
+        """Come calculate_price_range ma restituisce array NumPy (orizzonti lunghi)"""
+        dates = np.arange(start, end + timedelta(days=1), dtype="datetime64[D]")
+        events = self.get_events_for_range(start, end)
+        market = self.get_market_averages(start, end)
+        days = [start + timedelta(days=i) for i in range(len(dates))]
+        event_mults = [float(events[d]["multiplier"]) if d in events else np.nan for d in days]
+        market_avgs = [market.get(d, np.nan) for d in days]
+        forecasts = self.forecast.fill(start, end, market)
+        result = price_kernel(
+            dates, event_mults, market_avgs, self.config, [forecasts.get(d, np.nan) for d in days]
         )
-        if results and results[0]["avg_price"]:
-            return float(results[0]["avg_price"])
-        return None
+        result["date"] = dates
+        return result
 
     def calculate_optimal_price(self, target_date: date) -> Dict:
-        dow = target_date.weekday()
-        base_price = PRICES_CONFIG["BASE_WEEKEND"] if dow in [4, 5] else PRICES_CONFIG["BASE_WEEKDAY"]
-
-        reasoning = {"base_price": base_price, "factors": []}
-
-        # Eventi
-        event = self.get_event_for_date(target_date)
-        event_mult = 1.0
-        if event:
-            event_mult = float(event["multiplier"])
-            reasoning["event"] = {"name": event["name"], "multiplier": event_mult}
-            reasoning["factors"].append(f"Evento: {event['name']} (x{event_mult})")
-
-        # Stagionalità
-        season_mult = self.get_season_multiplier(target_date)
-        reasoning["season_multiplier"] = season_mult
-        if season_mult != 1.0:
-            reasoning["factors"].append(f"Stagione (x{season_mult})")
-
-        # Giorno settimana
-        dow_mult = self.get_dow_multiplier(target_date)
-        reasoning["dow_multiplier"] = dow_mult
-        if dow_mult != 1.0:
-            day_name = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"][dow]
-            reasoning["factors"].append(f"Giorno: {day_name} (x{dow_mult})")
-
-        # Mercato (opzionale se disponibile)
-        market_avg = self.get_market_average(target_date)
-        market_adj = 0.0
-        if market_avg:
-            market_adj = (market_avg - base_price) * 0.3
-            reasoning["market_avg"] = market_avg
-            reasoning["market_adjustment"] = round(market_adj, 2)
-            reasoning["factors"].append(f"Mercato: €{market_avg:.0f} (adj: €{market_adj:+.0f})")
-
-        calculated_price = (base_price + market_adj) * event_mult * season_mult * dow_mult
-        final_price = max(PRICES_CONFIG["MIN_PRICE"], min(PRICES_CONFIG["MAX_PRICE"], calculated_price))
-
-        reasoning["calculated"] = round(calculated_price, 2)
-        reasoning["final"] = round(final_price, 0)
-
-        confidence = 0.75  # Base confidence
-        if market_avg:
-            confidence += 0.15
-        if event:
-            confidence += 0.1
+        return self.calculate_price_range(target_date, target_date)[0]
+
+
+class ListingPortfolio:
+    """Tutte le proprietà attive: un PricingEngine ciascuna e ricalcolo in batch.
+
+    Il batch legge eventi (indice condiviso) e mercato con query costanti
+    rispetto al numero di proprietà, calcola le proprietà in sequenza nello
+    stesso processo (~5 ms per 365 giorni) e salva tutto con un solo bulk upsert.
+    """
+
+    def __init__(self, db: Database, default: PricingEngine):
+        self.db = db
+        self.default = default
+        self.engines: Dict[int, PricingEngine] = {default.property_id: default}
+        # Previsione su tutti i competitor (market_daily), condivisa dalle proprietà senza set
+        self.market_forecast = default.forecast
+        self.forecasts: Dict[str, MarketForecast] = {}
+
+    def load(self) -> List[PricingEngine]:
+        """Ricarica proprietà e set competitivi dal database"""
+        engines = {}
+        for listing in self.db.get_listings():
+            engine = self.engines.get(listing["id"]) or PricingEngine(
+                self.db, self.default.events, listing, self.forecast_for(listing), self.default.audit
+            )
+            engine.listing = listing
+            engine.forecast = self.forecast_for(listing)
+            engines[listing["id"]] = engine
+        engines.setdefault(self.default.property_id, self.default)
+        self.engines = engines
+        return list(engines.values())
+
+    def forecast_for(self, listing: Dict) -> MarketForecast:
+        """Previsione condivisa per chi usa tutti i competitor, propria per chi ha un set competitivo"""
+        if not listing.get("competitor_ids"):
+            return self.market_forecast
+        forecast = MarketForecast.for_listing(self.db, listing)
+        return self.forecasts.setdefault(forecast.name, forecast)
+
+    def update_forecasts(self) -> int:
+        """Aggiorna una volta ciascuna le previsioni di mercato in uso"""
+        forecasts = {id(e.forecast): e.forecast for e in self.engines.values()}
+        return sum(forecast.update() for forecast in forecasts.values())
+
+    def engine(self, code: str) -> Optional[PricingEngine]:
+        return next((e for e in self.engines.values() if e.listing["code"] == code), None)
+
+    def market_averages(self, start: date, end: date) -> Dict[int, Dict[date, float]]:
+        """Media di mercato per proprietà: al massimo due query per tutto il portafoglio"""
+        markets: Dict[int, Dict[date, float]] = {pid: {} for pid in self.engines}
+        with_set = [pid for pid, e in self.engines.items() if e.listing.get("competitor_ids")]
+        if with_set:
+            for row in self.db.get_property_market(start, end, with_set):
+                if row["avg_price"]:
+                    markets[row["property_id"]][row["date"]] = float(row["avg_price"])
+        if len(with_set) < len(self.engines):
+            shared = {
+                row["date"]: float(row["avg_price"])
+                for row in self.db.get_market_daily(start, end)
+                if row["avg_price"]
+            }
+            for pid in self.engines:
+                if pid not in with_set:
+                    markets[pid] = shared
+        return markets
+
+    def version(self) -> tuple:
+        return tuple(engine.version for engine in self.engines.values())
+
+    def on_catalog(self, old: CatalogSnapshot, new: CatalogSnapshot) -> Dict:
+        """Nuova snapshot del catalogo: invalida solo ciò che deriva dalle parti cambiate.
+
+        Le proprietà la cui config effettiva non cambia (es. chiave sovrascritta
+        dalla proprietà) tengono i suggerimenti; per gli eventi si ricalcolano
+        solo i giorni degli eventi tolti, aggiunti o modificati.
+        """
+        removed, added, days = new.changed_event_dates(old)
+        if removed or added:
+            # Anche in tabella events: al prossimo reload() l'indice resta coerente
+            self.db.sync_catalog_events(new.events)
+            self.default.events.replace(removed, added)
+        repriced = [e for e in self.engines.values() if e.config_for(old) != e.config_for(new)]
+        count = self.refresh_all(engines=repriced)
+        others = [e for e in self.engines.values() if e not in repriced]
+        if days:
+            count += self.refresh_all(dates=days, engines=others)
+        return {"repriced": repriced, "removed": removed, "added": added, "days": days, "suggestions": count}
+
+    def on_price_history(self, dates: List[date]):
+        for engine in self.engines.values():
+            engine.version += 1
+        self.refresh_all(dates=dates)
+
+    def on_new_events(self, events: List[Dict]):
+        self.default.events.add(events)
+        events = [normalize_event(e) for e in events]
+        if events:
+            self.refresh_all(min(e["start_date"] for e in events), max(e["end_date"] for e in events))
+
+    def refresh_all(
+        self,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        dates: Optional[List[date]] = None,
+        engines: Optional[List[PricingEngine]] = None,
+    ) -> int:
+        """Ricalcola e salva i suggerimenti di tutte le proprietà (o solo di engines) nell'orizzonte"""
+        window = suggestion_window(start, end, dates)
+        if window is None:
+            return 0
+        start, end, wanted = window
+        engines = list(self.engines.values()) if engines is None else engines
+        if not engines:
+            return 0
+        events = self.default.get_events_for_range(start, end)
+        markets = self.market_averages(start, end)
+        ranges = []
+        for engine in engines:
+            market = markets[engine.property_id]
+            forecasts = engine.forecast.fill(start, end, market)
+            ranges.append(price_range(start, end, events, market, engine.config, forecasts))
+
+        computed = []
+        for engine, results in zip(engines, ranges):
+            rows = [s for s in results if wanted is None or s["date"] in wanted]
+            for suggestion in rows:
+                suggestion["property_id"] = engine.property_id
+            computed.append(rows)
+        changed = self.db.upsert_suggestions([s for rows in computed for s in rows])
+        for engine, rows in zip(engines, computed):
+            if engine.audit is not None:
+                # Solo i giorni con prezzo/reasoning diversi da quelli salvati
+                rows = [s for s in rows if (engine.property_id, s["date"]) in changed]
+                engine.audit.record(rows, "refresh", engine.property_id)
+            engine.version += 1
+        return sum(len(rows) for rows in computed)
+
+
+def rate_changes(suggested: Dict[date, float], pushed: Dict[date, float]) -> List[Dict]:
+    """Date con prezzo diverso dall'ultimo push, fuse in range consecutivi a prezzo uguale.
+
+    {1/3: 80, 2/3: 80, 3/3: 80, 4/3: 95} con 3/3 già a 80 ->
+    [{start: 1/3, end: 2/3, price: 80}, {start: 4/3, end: 4/3, price: 95}]
+    """
+    rates: List[Dict] = []
+    for day in sorted(suggested):
+        price = round(suggested[day], 2)
+        if pushed.get(day) == price:
+            continue
+        last = rates[-1] if rates else None
+        if last and last["price"] == price and last["end"] + timedelta(days=1) == day:
+            last["end"] = day
+        else:
+            rates.append({"start": day, "end": day, "price": price})
+    return rates
+
+
+class ChannelManagerClient(ABC):
+    """Destinazione dei prezzi (channel manager/PMS). push_rates riceve range
+    {start, end (inclusa), price} e solleva un'eccezione se il push fallisce"""
+
+    name = "base"
+
+    @abstractmethod
+    def push_rates(self, listing: Dict, rates: List[Dict]):
+        ...
+
+    def remote_id(self, listing: Dict) -> str:
+        return CHANNEL_MANAGER_LISTINGS.get(listing["code"], listing["code"])
+
+
+class DryRunChannelManager(ChannelManagerClient):
+    """Nessuna chiamata: tiene i range in memoria (push --dry-run, benchmark)"""
+
+    name = "dry-run"
+
+    def __init__(self):
+        self.pushed: List[tuple] = []
+
+    def push_rates(self, listing: Dict, rates: List[Dict]):
+        self.pushed.append((self.remote_id(listing), rates))
+
+
+class HttpChannelManager(ChannelManagerClient):
+    """API JSON generica: POST {base_url}/listings/{id}/rates con {"rates": [...]}.
+
+    Retry con backoff su 429/5xx (Retry-After rispettato) dalla sessione
+    condivisa, al massimo una chiamata ogni min_interval secondi.
+    """
+
+    name = "http"
+
+    def __init__(
+        self,
+        base_url: str = CHANNEL_MANAGER_URL,
+        token: str = CHANNEL_MANAGER_TOKEN,
+        session: Optional[requests.Session] = None,
+        rate_limiter: Optional[HostRateLimiter] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.session = session or build_http_session(pool_size=1, retries=5)
+        self.rate_limiter = rate_limiter or HostRateLimiter(CHANNEL_MANAGER_MIN_INTERVAL)
+
+    def push_rates(self, listing: Dict, rates: List[Dict]):
+        url = f"{self.base_url}/listings/{self.remote_id(listing)}/rates"
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        payload = {
+            "currency": "EUR",
+            "rates": [
+                {"start": r["start"].isoformat(), "end": r["end"].isoformat(), "price": r["price"]}
+                for r in rates
+            ],
+        }
+        self.rate_limiter.wait(url)
+        response = self.session.post(url, json=payload, headers=headers, timeout=30)
+        response.raise_for_status()
+
+
+# Altri channel manager/PMS: sottoclasse di ChannelManagerClient registrata qui (CHANNEL_MANAGER=nome)
+CHANNEL_MANAGERS = {cls.name: cls for cls in (HttpChannelManager,)}
+
+
+def channel_push_enabled(kind: str = CHANNEL_MANAGER) -> bool:
+    """Push attivo: client noto e, per l'API HTTP, CHANNEL_MANAGER_URL impostato"""
+    if kind not in CHANNEL_MANAGERS:
+        raise ValueError(f"CHANNEL_MANAGER sconosciuto: {kind} (disponibili: {', '.join(CHANNEL_MANAGERS)})")
+    return kind != "http" or bool(CHANNEL_MANAGER_URL)
+
+
+class ChannelSync:
+    """Allinea il channel manager ai suggerimenti, inviando solo i prezzi cambiati.
+
+    Per ogni proprietà confronta l'orizzonte in pricing_suggestions con
+    channel_push_state (ultimo prezzo accettato). Le date cambiate vengono
+    fuse in range a prezzo uguale e inviate batch_size range per chiamata.
+    Lo stato si aggiorna solo per i batch andati a buon fine: dopo un errore
+    le date restano diverse e vengono ritentate alla sincronizzazione successiva.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        portfolio: ListingPortfolio,
+        client: Optional[ChannelManagerClient] = None,
+        batch_size: int = CHANNEL_PUSH_BATCH,
+    ):
+        self.db = db
+        self.portfolio = portfolio
+        self.client = client or CHANNEL_MANAGERS[CHANNEL_MANAGER]()
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+
+    def sync(self, today: Optional[date] = None) -> Optional[Dict]:
+        """Un giro su tutte le proprietà; None se un altro giro è già in corso"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            today = today or today_local()
+            end = today + timedelta(days=SUGGESTION_HORIZON_DAYS - 1)
+            stats = {"properties": 0, "dates": 0, "ranges": 0, "requests": 0, "failed": 0}
+            for engine in list(self.portfolio.engines.values()):
+                self._sync_listing(engine, today, end, stats)
+            return stats
+        finally:
+            self._lock.release()
+
+    def plan(self, engine: PricingEngine, start: date, end: date) -> tuple:
+        """(suggerimenti per data, range da inviare) per una proprietà, senza chiamate esterne"""
+        rows = {
+            row["date"]: PricingEngine._suggestion_from_row(row)
+            for row in self.db.get_suggestions(start, end, engine.property_id)
+        }
+        pushed = self.db.get_pushed_prices(engine.property_id, start, end)
+        return rows, rate_changes({d: s["suggested_price"] for d, s in rows.items()}, pushed)
 
+    def _sync_listing(self, engine: PricingEngine, start: date, end: date, stats: Dict):
+        rows, rates = self.plan(engine, start, end)
+        if not rates:
+            return
+        stats["properties"] += 1
+        for first in range(0, len(rates), self.batch_size):
+            batch = rates[first:first + self.batch_size]
+            stats["requests"] += 1
+            try:
+                self.client.push_rates(engine.listing, batch)
+            except Exception as e:
+                # Il resto dell'orizzonte di questa proprietà aspetta il prossimo giro
+                METRICS.inc("channel_push_requests_total", result="failed")
+                stats["failed"] += 1
+                logger.error(f"Channel push failed for {engine.listing['code']}: {e}")
+                return
+            METRICS.inc("channel_push_requests_total", result="ok")
+            prices = {
+                r["start"] + timedelta(days=i): r["price"]
+                for r in batch
+                for i in range((r["end"] - r["start"]).days + 1)
+            }
+            self.db.save_pushed_prices(engine.property_id, prices)
+            METRICS.inc("channel_push_dates_total", len(prices))
+            stats["dates"] += len(prices)
+            stats["ranges"] += len(batch)
+            if engine.audit is not None:
+                engine.audit.record([rows[d] for d in sorted(prices)], "channel", engine.property_id)
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """Process pool con start method spawn: nel bot girano già thread (server
+    health, pool DB, asyncio) e un fork erediterebbe lock presi da quei thread
+    (logging, psycopg2), con il rischio di bloccare i worker"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def expand_grid(grid: Dict[str, List], base: Optional[Dict] = None) -> List[Dict]:
+    """Prodotto cartesiano dei valori candidati, sovrapposto ai prezzi del catalogo"""
+    base = base or dict(CATALOG.snapshot.prices)
+    keys = list(grid)
+    return [{**base, **dict(zip(keys, values))} for values in itertools.product(*grid.values())]
+
+
+def simulate_configs(
+    data: Dict[str, np.ndarray],
+    configs: List[Dict],
+    base_occupancy: float = SIM_BASE_OCCUPANCY,
+    elasticity: float = SIM_ELASTICITY,
+) -> List[Dict]:
+    """Valuta un blocco di config sullo storico (in-process, o nei worker per griglie enormi).
+
+    Occupazione stimata = base_occupancy * (prezzo / riferimento) ** -elasticity,
+    dove il riferimento è la media di mercato del giorno o, senza dati di
+    mercato, il prezzo suggerito con i prezzi attuali del catalogo.
+    """
+    market = data["market_avg"]
+    reports = []
+    for config in configs:
+        events = data["event_multiplier"]
+        overrides = config.get("EVENT_MULTIPLIERS") or {}
+        for name, multiplier in overrides.items():
+            events = np.where(data["event_name"] == name, float(multiplier), events)
+
+        result = price_kernel(data["date"], events, market, config)
+        prices = result["suggested_price"]
+        has_market = result["has_market"]
+        reference = np.where(has_market, market, data["reference"])
+        occupancy = np.clip(base_occupancy * (prices / reference) ** -elasticity, 0.0, 1.0)
+        gap = (prices - market)[has_market]
+        gap_pct = gap / market[has_market] * 100 if has_market.any() else gap
+
+        reports.append({
+            "config": config,
+            "revenue": round(float((prices * occupancy).sum()), 2),
+            "occupancy": round(float(occupancy.mean()), 3),
+            "avg_price": round(float(prices.mean()), 2),
+            "market_days": int(has_market.sum()),
+            "market_gap": round(float(gap.mean()), 2) if gap.size else None,
+            "market_gap_abs": round(float(np.abs(gap).mean()), 2) if gap.size else None,
+            "market_gap_pct": round(float(gap_pct.mean()), 1) if gap.size else None,
+            "above_market_share": round(float((gap > 0).mean()), 3) if gap.size else None,
+        })
+    return reports
+
+
+def format_config(config: Dict, keys: Optional[List[str]] = None) -> str:
+    """'BASE_WEEKDAY=85 WEEKEND_MULTIPLIER=1.1 ...' per le chiavi simulate"""
+    keys = keys or list(SIM_DEFAULT_GRID)
+    return " ".join(f"{key}={config.get(key, 1.0):g}" for key in keys)
+
+
+class PriceSimulator:
+    """Backtest/what-if dei parametri prezzi su market_daily ed eventi storici"""
+
+    def __init__(self, pricing: PricingEngine, workers: int = SIM_WORKERS):
+        self.pricing = pricing
+        self.workers = workers
+
+    def load(self, start: date, end: date) -> Dict[str, np.ndarray]:
+        """Array di input (una query per il mercato, eventi da indice)"""
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        events = self.pricing.get_events_for_range(start, end)
+        market = self.pricing.get_market_averages(start, end)
+        data = {
+            "date": np.array(days, dtype="datetime64[D]"),
+            "event_multiplier": np.array(
+                [float(events[d]["multiplier"]) if d in events else np.nan for d in days]
+            ),
+            "event_name": np.array([events[d]["name"] if d in events else "" for d in days], dtype=object),
+            "market_avg": np.array([market.get(d, np.nan) for d in days]),
+        }
+        data["reference"] = price_kernel(data["date"], data["event_multiplier"], data["market_avg"])[
+            "suggested_price"
+        ]
+        return data
+
+    def run(self, configs: List[Dict], start: date, end: date) -> List[Dict]:
+        """Report per config, ordinati per ricavo stimato decrescente"""
+        if not configs or end < start:
+            return []
+        return self.evaluate(self.load(start, end), configs)
+
+    def evaluate(self, data: Dict[str, np.ndarray], configs: List[Dict]) -> List[Dict]:
+        workers = max(1, min(self.workers, len(configs)))
+        if workers == 1 or len(configs) < SIM_POOL_MIN_CONFIGS:
+            reports = simulate_configs(data, configs)
+        else:
+            size = -(-len(configs) // (workers * 4))
+            chunks = [configs[i:i + size] for i in range(0, len(configs), size)]
+            with process_pool(workers) as pool:
+                reports = [r for chunk in pool.map(simulate_configs, [data] * len(chunks), chunks) for r in chunk]
+        reports.sort(key=lambda r: -r["revenue"])
+        return reports
+
+    def backtest(self, grid: Optional[Dict[str, List]] = None, days: int = 365) -> Dict:
+        """Griglia (default SIM_DEFAULT_GRID) sugli ultimi `days` giorni, più la config attuale"""
+        end = today_local() - timedelta(days=1)
+        start = end - timedelta(days=days - 1)
+        data = self.load(start, end)
         return {
-            "date": target_date,
-            "suggested_price": round(final_price, 0),
-            "base_price": base_price,
-            "market_avg": market_avg,
-            "event_multiplier": event_mult if event else None,
-            "event_name": event["name"] if event else None,
-            "reasoning": reasoning,
-            "confidence": min(round(confidence, 2), 1.0),
+            "start": start,
+            "end": end,
+            "current": simulate_configs(data, [dict(CATALOG.snapshot.prices)])[0],
+            "results": self.evaluate(data, expand_grid(grid or SIM_DEFAULT_GRID)),
         }
 
 
-class MilanoExpressBot:
+class SingleFlight:
+    """Deduplica calcoli identici in corso: chi arriva mentre la stessa chiave è
+    in calcolo attende lo stesso risultato invece di ricalcolarlo.
+    """
+
     def __init__(self):
-        self.db = Database(DATABASE_URL)
-        self.pricing = PricingEngine(self.db)
-        self.event_fetcher = EventFetcher(self.db)
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+
+    async def run(self, key: tuple, func, *args):
+        """Esegue func(*args) in un thread, una volta sola per chiave in corso"""
+        task = self._inflight.get(key)
+        if task is None:
+            METRICS.inc("singleflight_total", kind=key[0], result="run")
+            task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._inflight.pop(key, None))
+        else:
+            METRICS.inc("singleflight_total", kind=key[0], result="shared")
+        # shield: se un chiamante viene cancellato il calcolo continua per gli altri
+        return await asyncio.shield(task)
+
+
+class ChatThrottle:
+    """Token bucket per utente in una chat: burst comandi subito, poi per_minute al minuto.
+
+    La chiave è (chat, utente): in un gruppo ogni membro ha il proprio bucket,
+    quindi dieci persone che scrivono /oggi insieme dopo il digest passano tutte.
+    """
+
+    def __init__(self, burst: int = CHAT_RATE_BURST, per_minute: float = CHAT_RATE_PER_MINUTE):
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self._buckets: Dict[tuple, tuple] = {}
+        self._warned: set = set()
+
+    def allow(self, key: tuple) -> bool:
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1.0, now)
+        self._warned.discard(key)
+        if len(self._buckets) > 10000:
+            # Bucket pieni equivalgono a nessun bucket: si possono scartare
+            full = now - self.burst / self.rate if self.rate else now
+            self._buckets = {k: v for k, v in self._buckets.items() if v[1] > full}
+            self._warned &= set(self._buckets)
+        return True
+
+    def warn(self, key: tuple) -> bool:
+        """True solo al primo comando rifiutato di una raffica: un avviso, non uno per comando"""
+        if key in self._warned:
+            return False
+        self._warned.add(key)
+        return True
+
+
+class OutboundQueue:
+    """Coda async dei messaggi in uscita, rispettando i limiti flood di Telegram.
+
+    Al massimo un messaggio ogni per_chat_interval secondi per chat (gruppi:
+    ~20/min) e global_rate messaggi/s in totale; su 429 (RetryAfter) la chat
+    resta ferma per retry_after secondi e il messaggio viene ritentato.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        per_chat_interval: float = OUTBOUND_CHAT_INTERVAL,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        max_retries: int = 5,
+    ):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1.0 / global_rate
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._next_global = 0.0
+        self._next_chat: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, chat_id: int, text: str, **kwargs):
+        self._queue.put_nowait((chat_id, text, kwargs))
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def join(self):
+        await self._queue.join()
+
+    async def run(self):
+        while True:
+            chat_id, text, kwargs = await self._queue.get()
+            try:
+                await self._send(chat_id, text, kwargs)
+            except Exception as e:
+                logger.error(f"Error sending message to {chat_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _wait_slot(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_global, self._next_chat.get(chat_id, now))
+        self._next_global = slot + self.global_interval
+        self._next_chat[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, chat_id: int, text: str, kwargs: Dict):
+        for attempt in range(self.max_retries):
+            await self._wait_slot(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                METRICS.inc("outbound_messages_total", result="sent")
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+                logger.warning(f"Telegram flood limit for {chat_id}: retry in {delay:.0f}s")
+                METRICS.inc("outbound_messages_total", result="throttled")
+                resume = asyncio.get_running_loop().time() + delay
+                self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0.0), resume)
+            except NetworkError as e:
+                logger.warning(f"Network error sending to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        METRICS.inc("outbound_messages_total", result="failed")
+        logger.error(f"Giving up sending message to {chat_id} after {self.max_retries} attempts")
+
+
+class MilanoExpressBot:
+    def __init__(self, db: Optional[Database] = None):
+        self.db = db or Database(DATABASE_URL)
+        self.audit = SuggestionAudit(self.db)
+        self.pricing = PricingEngine(self.db, audit=self.audit)
+        self.portfolio = ListingPortfolio(self.db, self.pricing)
+        # Scraper e feed (requests, bs4, feedparser) creati al primo job, non all'avvio
+        self._event_fetcher: Optional[EventFetcher] = None
+        self._scraper: Optional[CompetitorScraper] = None
+        self._channel: Optional[ChannelSync] = None
+        self.replies = ResponseCache()
+        self.inflight = SingleFlight()
+        self.throttle = ChatThrottle()
         self.bot = Bot(token=BOT_TOKEN)
+        self.outbound: Optional[OutboundQueue] = None
+        self.digests: Optional[Dict] = None
+
+    @property
+    def event_fetcher(self) -> EventFetcher:
+        if self._event_fetcher is None:
+            self._event_fetcher = EventFetcher(self.db)
+        return self._event_fetcher
+
+    @property
+    def scraper(self) -> CompetitorScraper:
+        if self._scraper is None:
+            self._scraper = CompetitorScraper(self.db)
+        return self._scraper
+
+    @property
+    def channel(self) -> ChannelSync:
+        if self._channel is None:
+            self._channel = ChannelSync(self.db, self.portfolio)
+        return self._channel
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         welcome = (
@@ -455,15 +3265,35 @@ class MilanoExpressBot:
             "/domani - Previsione domani\n"
             "/settimana - Trend 7 giorni\n"
             "/eventi - Eventi prossimi 2026\n"
+            "/proprieta - Prezzi di oggi per ogni proprietà\n"
+            "/simula - Backtest configurazioni prezzi (admin)\n"
+            "/calendario - Calendario prezzi CSV/ICS\n"
             "/help - Lista comandi\n\n"
             "📍 Calibrato su mercato reale Seveso/Milano Nord\n"
             "Sviluppato per Milano Express B&B 🇮🇹"
         )
         await update.message.reply_text(welcome, parse_mode="Markdown")
 
-    async def oggi(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        today = date.today()
-        result = self.pricing.calculate_optimal_price(today)
+    def data_version(self) -> tuple:
+        """Cambia a ogni scrittura di eventi o prezzi (chiave della cache risposte)"""
+        return (self.pricing.version, self.pricing.events.version)
+
+    async def cached_reply(self, command: str, render, version: Optional[tuple] = None) -> str:
+        """Testo renderizzato da cache (comando, data locale, versione dati) o calcolato una volta"""
+        today = today_local()
+        key = (command, today, version or self.data_version())
+        message = self.replies.get(key)
+        if message is None:
+            METRICS.record_cache("replies", hit=0, miss=1)
+            # Richieste identiche simultanee (es. tutto il gruppo dopo il digest): un solo render
+            message = await self.inflight.run(key, render, today)
+            self.replies.put(key, message)
+        else:
+            METRICS.record_cache("replies", hit=1)
+        return message
+
+    def render_oggi(self, today: date) -> str:
+        result = self.pricing.get_suggestions(today, today, source="oggi")[0]
 
         message = (
             f"📅 *Analisi per oggi* ({today.strftime('%d/%m/%Y')})\n\n"
@@ -475,18 +3305,18 @@ class MilanoExpressBot:
         if result["market_avg"]:
             message += f"• Media mercato: €{result['market_avg']:.0f}\n"
         if result["event_name"]:
-            message += f"• 🎯 Evento: {result['event_name']}\n"
+            message += f"• 🎯 Evento: {md_escape(result['event_name'])}\n"
         if result["reasoning"]["factors"]:
             message += "\n🔍 Fattori applicati:\n"
             for factor in result["reasoning"]["factors"]:
-                message += f"  • {factor}\n"
+                message += f"  • {md_escape(factor)}\n"
 
         message += f"\n✅ Confidenza: {result['confidence'] * 100:.0f}%"
-        await update.message.reply_text(message, parse_mode="Markdown")
+        return message
 
-    async def domani(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        tomorrow = date.today() + timedelta(days=1)
-        result = self.pricing.calculate_optimal_price(tomorrow)
+    def render_domani(self, today: date) -> str:
+        tomorrow = today + timedelta(days=1)
+        result = self.pricing.get_suggestions(tomorrow, tomorrow, source="domani")[0]
 
         message = (
             f"📅 *Previsione per domani* ({tomorrow.strftime('%d/%m/%Y')})\n\n"
@@ -496,19 +3326,18 @@ class MilanoExpressBot:
         )
 
         if result["event_name"]:
-            message += f"• ⭐ Evento: *{result['event_name']}*\n"
+            message += f"• ⭐ Evento: {md_bold(result['event_name'])}\n"
 
         message += f"\n✅ Confidenza: {result['confidence'] * 100:.0f}%"
-        await update.message.reply_text(message, parse_mode="Markdown")
+        return message
 
-    async def settimana(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def render_settimana(self, today: date) -> str:
         message = "📊 *Trend prossimi 7 giorni*\n\n"
         total = 0.0
 
-        for i in range(7):
-            target_date = date.today() + timedelta(days=i)
-            result = self.pricing.calculate_optimal_price(target_date)
-
+        results = self.pricing.get_suggestions(today, today + timedelta(days=6), source="settimana")
+        for result in results:
+            target_date = result["date"]
             day_name = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"][target_date.weekday()]
             event_emoji = "🎯" if result["event_name"] else ""
 
@@ -518,22 +3347,13 @@ class MilanoExpressBot:
         avg = total / 7.0
         message += f"\n💰 Media settimanale: €{avg:.0f}/notte"
         message += f"\n📈 Ricavo stimato 7gg: €{total:.0f}"
-        await update.message.reply_text(message, parse_mode="Markdown")
+        return message
 
-    async def eventi(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        today = date.today()
-        results = self.db.execute(
-            "SELECT name, start_date, end_date, category, impact_score, multiplier "
-            "FROM events "
-            "WHERE end_date >= %s "
-            "ORDER BY start_date LIMIT 15",
-            (today,),
-            fetch=True,
-        )
+    def render_eventi(self, today: date) -> str:
+        results = self.pricing.events.upcoming(today, 15)
 
         if not results:
-            await update.message.reply_text("Nessun evento trovato nei prossimi mesi.")
-            return
+            return "Nessun evento trovato nei prossimi mesi."
 
         message = "📅 *Eventi prossimi con impatto prezzi:*\n\n"
 
@@ -552,22 +3372,304 @@ class MilanoExpressBot:
                 status = f"⚪ Tra {days_until} giorni"
 
             message += f"{status}\n"
-            message += f"*{event['name']}*\n"
+            message += f"{md_bold(event['name'])}\n"
             message += f"📍 {start.strftime('%d/%m')} - {end.strftime('%d/%m/%Y')}\n"
             message += f"💰 Prezzo x{event['multiplier']}\n\n"
 
+        return message
+
+    def render_proprieta(self, today: date) -> str:
+        message = f"🏘️ *Proprietà* - prezzi suggeriti oggi ({today.strftime('%d/%m/%Y')})\n\n"
+        for engine in self.portfolio.engines.values():
+            result = engine.get_suggestions(today, today, source="proprieta")[0]
+            message += f"• {md_bold(engine.listing['name'])}: €{result['suggested_price']:.0f}"
+            if result["event_name"]:
+                message += " 🎯"
+            message += "\n"
+        return message
+
+    async def oggi(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = await self.cached_reply("oggi", self.render_oggi)
+        await update.message.reply_text(message, parse_mode="Markdown")
+
+    async def domani(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = await self.cached_reply("domani", self.render_domani)
+        await update.message.reply_text(message, parse_mode="Markdown")
+
+    async def settimana(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = await self.cached_reply("settimana", self.render_settimana)
+        await update.message.reply_text(message, parse_mode="Markdown")
+
+    async def eventi(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = await self.cached_reply("eventi", self.render_eventi)
+        await update.message.reply_text(message, parse_mode="Markdown")
+
+    async def proprieta(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Dipende da tutte le proprietà, non solo da quella di default
+        version = self.portfolio.version() + (self.pricing.events.version,)
+        message = await self.cached_reply("proprieta", self.render_proprieta, version)
         await update.message.reply_text(message, parse_mode="Markdown")
 
+    def build_calendar(self, today: date, days: int) -> tuple:
+        """(CSV, ICS) in memoria per i prossimi `days` giorni, dai suggerimenti precalcolati"""
+        end = today + timedelta(days=days - 1)
+        suggestions = self.pricing.get_suggestions(today, end, source="calendario")
+        events = self.pricing.events.between(today, end)
+        code = self.pricing.listing["code"]
+        return (
+            calendar_file(write_calendar_csv, suggestions),
+            calendar_file(write_calendar_ics, suggestions, events, code),
+        )
+
+    async def calendario(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/calendario [giorni]: calendario prezzi 30-365 giorni come documenti CSV e ICS"""
+        try:
+            days = int(context.args[0]) if context.args else 90
+        except ValueError:
+            await update.message.reply_text("Uso: /calendario [giorni] (es. /calendario 365)")
+            return
+        days = max(30, min(days, 365))
+        today = today_local()
+        key = ("calendario", today, days, self.data_version())
+        files = await self.inflight.run(key, self.build_calendar, today, days)
+        # Buffer condivisi tra chiamanti: ognuno invia una propria copia
+        csv_file, ics_file = (io.BytesIO(f.getvalue()) for f in files)
+        name = f"prezzi_{today:%Y%m%d}_{days}g"
+        await update.message.reply_document(
+            csv_file, filename=f"{name}.csv",
+            caption=f"📅 Calendario prezzi {days} giorni dal {today.strftime('%d/%m/%Y')}",
+        )
+        await update.message.reply_document(ics_file, filename=f"{name}.ics")
+
+    def build_digests(self, today: date) -> Dict:
+        """Digest del gruppo calcolati in un unico batch: 7 giorni di suggerimenti e indice eventi"""
+        week = self.pricing.get_suggestions(today, today + timedelta(days=6), source="digest")
+        upcoming = self.pricing.events.upcoming(today, 50)
+        tomorrow = today + timedelta(days=1)
+        result = week[0]
+
+        daily = (
+            f"☀️ *Buongiorno! Report del {today.strftime('%d/%m/%Y')}*\n\n"
+            f"💰 Prezzo suggerito oggi: *€{result['suggested_price']:.0f}*\n"
+        )
+        if result["market_avg"]:
+            daily += f"📊 Media mercato: €{result['market_avg']:.0f}\n"
+        soon = [e for e in upcoming if e["start_date"] <= tomorrow]
+        if soon:
+            daily += "\n🎯 Eventi nelle prossime 48h:\n"
+            for event in soon:
+                daily += f"  • {md_escape(event['name'])} (x{event['multiplier']})\n"
+
+        weekly = "📈 *Outlook settimanale*\n\n"
+        for day in week:
+            day_name = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"][day["date"].weekday()]
+            event_emoji = "🎯" if day["event_name"] else ""
+            weekly += f"{day_name} {day['date'].strftime('%d/%m')}: *€{day['suggested_price']:.0f}* {event_emoji}\n"
+        total = sum(float(day["suggested_price"]) for day in week)
+        weekly += f"\n💰 Media: €{total / len(week):.0f}/notte, ricavo stimato 7gg: €{total:.0f}\n"
+        important = [
+            e for e in upcoming
+            if (e["impact_score"] or 0) >= EVENT_ALERT_IMPACT and e["start_date"] <= today + timedelta(days=30)
+        ]
+        if important:
+            weekly += "\n⭐ Eventi importanti in arrivo:\n"
+            for event in important:
+                weekly += f"  • {md_escape(event['name'])} dal {event['start_date'].strftime('%d/%m')}\n"
+
+        alerts = []
+        starting = [
+            e for e in upcoming
+            if e["start_date"] == tomorrow and (e["impact_score"] or 0) >= EVENT_ALERT_IMPACT
+        ]
+        for event in starting:
+            alerts.append(
+                f"⚠️ {md_bold(event['name'])} domani - Alza prezzo!\n"
+                f"💰 Suggerito per domani: €{week[1]['suggested_price']:.0f} (x{event['multiplier']})"
+            )
+
+        return {"date": today, "daily": daily, "weekly": weekly, "alerts": alerts}
+
+    async def current_digests(self) -> Dict:
+        """Digest precalcolati di oggi; se mancano (es. riavvio o giorno diverso) vengono calcolati ora"""
+        today = today_local()
+        if not self.digests or self.digests["date"] != today:
+            self.digests = await asyncio.to_thread(self.build_digests, today)
+        return self.digests
+
+    async def prepare_digests_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: calcola in anticipo i digest del prossimo report (domani se gira prima di mezzanotte)"""
+        try:
+            self.digests = await asyncio.to_thread(self.build_digests, next_digest_date())
+            logger.info(f"Group digests prepared ({len(self.digests['alerts'])} event alerts)")
+        except Exception as e:
+            logger.error(f"Error preparing group digests: {e}")
+
+    async def daily_digest_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: report giornaliero e alert eventi di domani nel gruppo"""
+        try:
+            digests = await self.current_digests()
+            self.outbound.put(GROUP_CHAT_ID, digests["daily"], parse_mode="Markdown")
+            for alert in digests["alerts"]:
+                self.outbound.put(GROUP_CHAT_ID, alert, parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Error sending daily digest: {e}")
+
+    async def weekly_digest_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job del lunedì: outlook settimanale nel gruppo"""
+        try:
+            digests = await self.current_digests()
+            self.outbound.put(GROUP_CHAT_ID, digests["weekly"], parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Error sending weekly digest: {e}")
+
+    async def simula(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/simula [giorni]: backtest della griglia SIM_DEFAULT_GRID sullo storico (solo ADMIN_USER_IDS)"""
+        user = update.effective_user
+        if user is None or user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("⛔ Comando riservato agli amministratori (ADMIN_USER_IDS).")
+            return
+        try:
+            days = int(context.args[0]) if context.args else 365
+        except ValueError:
+            await update.message.reply_text("Uso: /simula [giorni] (es. /simula 180)")
+            return
+        days = max(7, min(days, 730))
+        await update.message.reply_text(f"⏳ Simulazione su {days} giorni in corso...")
+        key = ("simula", today_local(), days, self.data_version(), CATALOG.snapshot.version)
+        report = await self.inflight.run(key, PriceSimulator(self.pricing).backtest, None, days)
+        current = report["current"]
+
+        message = (
+            f"🧪 *Simulazione prezzi* ({report['start'].strftime('%d/%m/%Y')} - "
+            f"{report['end'].strftime('%d/%m/%Y')})\n"
+            f"{len(report['results'])} configurazioni, {current['market_days']} giorni con dati mercato\n\n"
+            f"📌 *Config attuale:* ricavo €{current['revenue']:.0f}"
+        )
+        if current["market_gap"] is not None:
+            message += f", scarto mercato €{current['market_gap']:+.0f}"
+        message += "\n\n🏆 *Migliori configurazioni:*\n"
+        for i, result in enumerate(report["results"][:5], 1):
+            message += f"{i}. €{result['revenue']:.0f} ({result['revenue'] - current['revenue']:+.0f})"
+            if result["market_gap"] is not None:
+                message += f", scarto €{result['market_gap']:+.0f}"
+            message += f"\n   `{format_config(result['config'])}`\n"
+        await update.message.reply_text(message, parse_mode="Markdown")
+
+    def reload_catalog(self) -> tuple:
+        """Pubblica il catalogo aggiornato e invalida solo i dati derivati dalle parti cambiate"""
+        old, new = CATALOG.reload(self.db)
+        if new is old:
+            return new, None
+        self.portfolio.load()
+        result = self.portfolio.on_catalog(old, new)
+        if self.pricing in result["repriced"] or result["days"]:
+            self.digests = None
+        logger.info(
+            f"Catalog v{new.version}: {len(result['repriced'])} properties repriced, "
+            f"events -{len(result['removed'])} +{len(result['added'])}, {result['suggestions']} suggestions"
+        )
+        return new, result
+
+    async def ricarica(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/ricarica: rilegge catalogo prezzi ed eventi senza riavviare (solo ADMIN_USER_IDS)"""
+        user = update.effective_user
+        if user is None or user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("⛔ Comando riservato agli amministratori (ADMIN_USER_IDS).")
+            return
+        try:
+            snapshot, result = await asyncio.to_thread(self.reload_catalog)
+        except (OSError, ValueError, KeyError) as e:
+            await update.message.reply_text(f"❌ Catalogo non valido, resta v{CATALOG.snapshot.version}: {e}")
+            return
+        if result is None:
+            await update.message.reply_text(
+                f"✅ Nessuna modifica: catalogo v{snapshot.version} ({snapshot.source})"
+            )
+            return
+        await update.message.reply_text(
+            f"✅ Catalogo v{snapshot.version} caricato ({snapshot.source})\n"
+            f"• Proprietà ricalcolate: {len(result['repriced'])}\n"
+            f"• Eventi: {len(result['added'])} nuovi/modificati, {len(result['removed'])} tolti/modificati\n"
+            f"• Giorni ricalcolati per eventi: {len(result['days'])}"
+        )
+
+    async def watch_catalog_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: ricarica il catalogo quando il file PRICING_CATALOG_PATH cambia"""
+        if not CATALOG.file_changed():
+            return
+        try:
+            await asyncio.to_thread(self.reload_catalog)
+        except Exception as e:
+            logger.error(f"Error reloading pricing catalog: {e}")
+
+    async def refresh_suggestions_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job periodico: mantiene pieno l'orizzonte di pricing_suggestions"""
+        try:
+            listings = await asyncio.to_thread(self.portfolio.load)
+            count = await asyncio.to_thread(self.portfolio.refresh_all)
+            logger.info(f"Pricing suggestions refreshed: {count} days for {len(listings)} properties")
+        except Exception as e:
+            logger.error(f"Error refreshing pricing suggestions: {e}")
+
+    async def scrape_competitors_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job notturno: scraping competitor e ricalcolo delle sole date toccate"""
+        try:
+            dates = await asyncio.to_thread(self.scraper.scrape_all)
+            if dates:
+                await asyncio.to_thread(self.portfolio.update_forecasts)
+                await asyncio.to_thread(self.portfolio.on_price_history, dates)
+        except Exception as e:
+            logger.error(f"Error in competitor scraping job: {e}")
+
+    async def maintain_price_history_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job giornaliero: compattazione/retention di price_history"""
+        try:
+            removed = await asyncio.to_thread(
+                self.db.compact_price_history, PRICE_HISTORY_COMPACT_DAYS, PRICE_HISTORY_DROP_MONTHS
+            )
+            logger.info(f"price_history compacted: {removed} rows removed")
+            if AUDIT_RETENTION_DAYS > 0:
+                await asyncio.to_thread(self.db.prune_suggestion_audit, AUDIT_RETENTION_DAYS)
+            await asyncio.to_thread(self.db.prune_pushed_prices, today_local())
+        except Exception as e:
+            logger.error(f"Error compacting price_history: {e}")
+
+    async def channel_sync_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job periodico: invia al channel manager solo i prezzi cambiati dall'ultimo push"""
+        try:
+            stats = await asyncio.to_thread(self.channel.sync)
+            if stats and stats["requests"]:
+                logger.info(
+                    f"Channel push: {stats['dates']} dates in {stats['ranges']} ranges, "
+                    f"{stats['requests']} requests ({stats['failed']} failed) for {stats['properties']} properties"
+                )
+        except Exception as e:
+            logger.error(f"Error pushing prices to channel manager: {e}")
+
+    async def fetch_events_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job periodico: ingestione incrementale del feed eventi"""
+        try:
+            events = await asyncio.to_thread(self.event_fetcher.update_events_from_sources)
+            if events:
+                await asyncio.to_thread(self.portfolio.on_new_events, events)
+        except Exception as e:
+            logger.error(f"Error ingesting event feed: {e}")
+
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text = (
             "🤖 *Comandi disponibili:*\n\n"
             "📊 *Analisi Prezzi*\n"
             "/oggi - Prezzo suggerito oggi\n"
             "/domani - Previsione domani\n"
-            "/settimana - Trend 7 giorni\n\n"
+            "/settimana - Trend 7 giorni\n"
+            "/proprieta - Prezzi di oggi per ogni proprietà\n"
+            "/calendario [giorni] - Calendario prezzi da scaricare (CSV e ICS)\n\n"
             "📅 *Eventi*\n"
             "/eventi - Lista eventi 2026\n\n"
+            "🧪 *Simulazione*\n"
+            "/simula [giorni] - Confronta configurazioni prezzi sullo storico (admin)\n\n"
             "⚙️ *Altro*\n"
+            "/ricarica - Ricarica catalogo prezzi/eventi (admin)\n"
             "/help - Questo messaggio\n\n"
             "💡 *Come funziona:*\n"
             "Il bot analizza eventi (Olimpiadi, Salone, Formula 1), "
@@ -579,12 +3681,31 @@ class MilanoExpressBot:
         await update.message.reply_text(help_text, parse_mode="Markdown")
 
 
+def health_response(path: str) -> tuple:
+    """(status, body, content type) per /healthz, / e /metrics, comune ai due server"""
+    if path == "/metrics":
+        for phase, seconds in STARTUP.phases.items():
+            METRICS.set("startup_seconds", seconds, phase=phase)
+        for module, seconds in STARTUP.imports.items():
+            METRICS.set("startup_import_seconds", seconds, module=module)
+        return 200, METRICS.render().encode(), "text/plain; version=0.0.4; charset=utf-8"
+    if path == "/healthz":
+        return 200, b"ok", "text/plain"
+    if path == "/":
+        return 200, b"Bot is running - Milano Express Pricing v2.1", "text/plain"
+    return 404, b"not found", "text/plain"
+
+
 class HealthCheckHandler(BaseHTTPRequestHandler):
+    """Server HTTP su PORT in modalità polling: health check e /metrics (formato Prometheus)"""
+
     def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
+        status, body, content_type = health_response(self.path)
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(b"Bot is running - Milano Express Pricing v2.1")
+        self.wfile.write(body)
 
     def log_message(self, format, *args):
         return
@@ -592,37 +3713,345 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
 
 def start_health_server():
     port = int(os.environ.get("PORT", "10000"))
-    server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
+    server = ThreadingHTTPServer(("0.0.0.0", port), HealthCheckHandler)
     server.serve_forever()
 
 
-def main():
-    # Init database
+def build_web_app(state: Dict):
+    """App tornado per la modalità webhook: webhook Telegram, /healthz e /metrics sulla stessa porta.
+
+    state["application"] è None finché il bot non è inizializzato: nel frattempo
+    il webhook risponde 503 e Telegram ritenta la consegna. Con state["secret"]
+    gli update senza l'header X-Telegram-Bot-Api-Secret-Token giusto ricevono 403.
+    """
+    import tornado.web
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            status, body, content_type = health_response(self.request.path)
+            self.set_status(status)
+            self.set_header("Content-Type", content_type)
+            self.finish(body)
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            application = state.get("application")
+            if application is None:
+                self.set_status(503)
+                return
+            secret = state.get("secret")
+            if secret and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                self.set_status(403)
+                return
+            try:
+                data = json.loads(self.request.body)
+                if not isinstance(data, dict):
+                    raise ValueError("update is not a JSON object")
+                update = Update.de_json(data, application.bot)
+            except (ValueError, TypeError, KeyError):
+                self.set_status(400)
+                return
+            await application.update_queue.put(update)
+
+        def log_exception(self, typ, value, tb):
+            logger.error(f"Webhook error: {value}")
+
+    return tornado.web.Application(
+        [(WEBHOOK_PATH, WebhookHandler), (r"/(?:healthz|metrics)?", HealthHandler)],
+        log_function=lambda handler: None,
+    )
+
+
+def parse_grid(specs: List[str]) -> Dict[str, List[float]]:
+    """['BASE_WEEKDAY=70,80,90', ...] -> {'BASE_WEEKDAY': [70.0, 80.0, 90.0]}
+
+    Solo chiavi numeriche del catalogo prezzi ed EVENT_SCALE: EVENT_MULTIPLIERS
+    (nome evento -> moltiplicatore) non è una lista di valori da combinare.
+    """
+    allowed = sorted(
+        {k for k, v in CATALOG.snapshot.prices.items() if isinstance(v, (int, float))} | {"EVENT_SCALE"}
+    )
+    grid = {}
+    for spec in specs:
+        key, _, values = spec.partition("=")
+        key = key.strip().upper()
+        if not values:
+            raise argparse.ArgumentTypeError(f"Griglia non valida: {spec!r} (atteso CHIAVE=v1,v2,...)")
+        if key not in allowed:
+            raise argparse.ArgumentTypeError(
+                f"Chiave non simulabile: {key} (disponibili: {', '.join(allowed)}; "
+                f"per gli eventi usa EVENT_SCALE)"
+            )
+        try:
+            grid[key] = [float(v) for v in values.split(",")]
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Valori non numerici in {spec!r}") from None
+    return grid
+
+
+def run_simulation(args):
+    db = Database(DATABASE_URL)
+    simulator = PriceSimulator(PricingEngine(db), workers=args.workers)
+    grid = args.grid
+    started = time.perf_counter()
+    report = simulator.backtest(grid, args.days)
+    elapsed = time.perf_counter() - started
+    db.close()
+
+    if args.json:
+        print(json.dumps(
+            {**report, "results": report["results"][:args.top], "configs": len(report["results"])},
+            default=str,
+            indent=2,
+        ))
+        return
+
+    current = report["current"]
+    print(
+        f"{len(report['results'])} config, {report['start']} - {report['end']}, "
+        f"{current['market_days']} giorni con dati mercato, {elapsed:.2f}s"
+    )
+    print(f"{'ricavo':>10} {'occ':>6} {'prezzo':>7} {'scarto':>7} {'scarto%':>8}  config")
+    for label, result in [("attuale", current)] + [(str(i), r) for i, r in enumerate(report["results"][:args.top], 1)]:
+        gap = result["market_gap"]
+        gap_pct = result["market_gap_pct"]
+        print(
+            f"{result['revenue']:>10.0f} {result['occupancy']:>6.2f} {result['avg_price']:>7.1f} "
+            f"{'-' if gap is None else f'{gap:+.1f}':>7} {'-' if gap_pct is None else f'{gap_pct:+.1f}':>8}  "
+            f"[{label}] {format_config(result['config'], list(grid))}"
+        )
+
+
+def run_push(args):
     db = Database(DATABASE_URL)
     db.init_schema()
+    portfolio = ListingPortfolio(db, PricingEngine(db))
+    portfolio.load()
+    today = today_local()
+    if args.dry_run:
+        sync = ChannelSync(db, portfolio, client=DryRunChannelManager())
+        end = today + timedelta(days=SUGGESTION_HORIZON_DAYS - 1)
+        for engine in portfolio.engines.values():
+            _, rates = sync.plan(engine, today, end)
+            days = sum((r["end"] - r["start"]).days + 1 for r in rates)
+            batches = -(-len(rates) // sync.batch_size)
+            print(f"{engine.listing['code']}: {days} date in {len(rates)} range, {batches} chiamate")
+            for r in rates:
+                print(f"  {r['start']} - {r['end']}  €{r['price']:.2f}")
+    elif not channel_push_enabled():
+        print("Push disattivato: imposta CHANNEL_MANAGER_URL")
+    else:
+        stats = ChannelSync(db, portfolio).sync(today)
+        print(
+            f"{stats['dates']} date in {stats['ranges']} range, {stats['requests']} chiamate "
+            f"({stats['failed']} fallite), {stats['properties']} proprietà"
+        )
+    db.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Milano Express Pricing Bot")
+    commands = parser.add_subparsers(dest="command")
+    simula = commands.add_parser("simula", help="Backtest di una griglia di parametri prezzi sullo storico")
+    simula.add_argument("--days", type=int, default=365, help="giorni di storico (fino a ieri)")
+    simula.add_argument(
+        "--grid", action="append", metavar="CHIAVE=v1,v2",
+        help="valori candidati (ripetibile); default SIM_DEFAULT_GRID",
+    )
+    simula.add_argument("--top", type=int, default=10)
+    simula.add_argument("--workers", type=int, default=SIM_WORKERS)
+    simula.add_argument("--json", action="store_true")
+    push = commands.add_parser("push", help="Invia al channel manager i prezzi cambiati dall'ultimo push")
+    push.add_argument("--dry-run", action="store_true", help="mostra i range da inviare senza chiamare l'API")
+    args = parser.parse_args(argv)
+
+    if args.command == "simula":
+        try:
+            args.grid = parse_grid(args.grid) if args.grid else SIM_DEFAULT_GRID
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+        run_simulation(args)
+    elif args.command == "push":
+        run_push(args)
+    else:
+        run_bot()
+
+
+def build_application(
+    db: Database, bot_instance: Optional[MilanoExpressBot] = None, request=None
+) -> Application:
+    """Application con handler e job; request (telegram.request.BaseRequest) sostituisce
+    il client HTTP verso Telegram, es. l'API finta di loadtest.py"""
+    bot_instance = bot_instance or MilanoExpressBot(db)
+
+    async def post_init(app: Application):
+        # Riferimento in bot_data: il task non deve essere raccolto dal GC
+        app.bot_data["loop_monitor"] = asyncio.create_task(monitor_event_loop())
+        app.bot_data["outbound"] = bot_instance.outbound.start()
+        STARTUP.mark("bot_ready")
+        logger.info(f"Bot ready {STARTUP.phases['bot_ready']:.2f}s after process start")
+
+    async def post_shutdown(app: Application):
+        # Le righe audit ancora in memoria vengono scritte prima di uscire
+        await asyncio.to_thread(bot_instance.audit.close)
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UPDATE_WORKERS)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
+    bot_instance.outbound = OutboundQueue(application.bot)
+
+    # Register handlers (con latenza per comando su /metrics)
+    commands = {
+        "start": bot_instance.start,
+        "oggi": bot_instance.oggi,
+        "domani": bot_instance.domani,
+        "settimana": bot_instance.settimana,
+        "eventi": bot_instance.eventi,
+        "proprieta": bot_instance.proprieta,
+        "simula": bot_instance.simula,
+        "calendario": bot_instance.calendario,
+        "ricarica": bot_instance.ricarica,
+        "help": bot_instance.help_command,
+    }
+    for command, handler in commands.items():
+        application.add_handler(
+            CommandHandler(command, instrument_command(command, handler, bot_instance.throttle))
+        )
+
+    # Precalcolo orizzonte prezzi (rolling, SUGGESTION_HORIZON_DAYS giorni)
+    application.job_queue.run_repeating(
+        bot_instance.refresh_suggestions_job,
+        interval=timedelta(hours=SUGGESTION_REFRESH_HOURS),
+        first=5,
+        name="refresh_suggestions",
+    )
+    if SCRAPER_ENABLED:
+        application.job_queue.run_daily(
+            bot_instance.scrape_competitors_job,
+            time=dtime(SCRAPER_HOUR, 0, tzinfo=ROME_TZ),
+            name="scrape_competitors",
+        )
+    application.job_queue.run_daily(
+        bot_instance.maintain_price_history_job,
+        time=dtime((SCRAPER_HOUR + 1) % 24, 30, tzinfo=ROME_TZ),
+        name="maintain_price_history",
+    )
+
+    if channel_push_enabled():
+        application.job_queue.run_repeating(
+            bot_instance.channel_sync_job,
+            interval=timedelta(minutes=CHANNEL_SYNC_MINUTES),
+            first=120,
+            name="channel_sync",
+        )
+
+    if CATALOG.path:
+        application.job_queue.run_repeating(
+            bot_instance.watch_catalog_job,
+            interval=timedelta(seconds=CATALOG_WATCH_SECONDS),
+            first=CATALOG_WATCH_SECONDS,
+            name="watch_catalog",
+        )
+
+    application.job_queue.run_repeating(
+        bot_instance.fetch_events_job,
+        interval=timedelta(hours=EVENT_FEED_REFRESH_HOURS),
+        first=60,
+        name="fetch_events",
+    )
+
+    # Digest nel gruppo: calcolo in batch DIGEST_PREPARE_MINUTES prima, invio via OutboundQueue
+    if GROUP_CHAT_ID:
+        prepare_at = datetime(2000, 1, 2, DIGEST_HOUR) - timedelta(minutes=DIGEST_PREPARE_MINUTES)
+        application.job_queue.run_daily(
+            bot_instance.prepare_digests_job,
+            time=dtime(prepare_at.hour, prepare_at.minute, tzinfo=ROME_TZ),
+            name="prepare_digests",
+        )
+        application.job_queue.run_daily(
+            bot_instance.daily_digest_job,
+            time=dtime(DIGEST_HOUR, 0, tzinfo=ROME_TZ),
+            name="daily_digest",
+        )
+        application.job_queue.run_daily(
+            bot_instance.weekly_digest_job,
+            time=dtime(WEEKLY_DIGEST_HOUR, 0, tzinfo=ROME_TZ),
+            days=(1,),  # PTB 20: 0 = domenica, 1 = lunedì
+            name="weekly_digest",
+        )
+    else:
+        logger.warning("GROUP_CHAT_ID not set: group digests disabled")
+    return application
 
-    # Start health check server
+
+async def run_webhook():
+    """Modalità webhook: un solo server async su PORT, attivo prima delle migrazioni"""
+    import signal
+
+    port = int(os.environ.get("PORT", "10000"))
+    # Endpoint pubblico: senza WEBHOOK_SECRET se ne genera uno a ogni avvio (registrato con
+    # set_webhook), così nessuno può inviare update finti. Solo in locale resta aperto.
+    secret = WEBHOOK_SECRET or (secrets.token_urlsafe(32) if WEBHOOK_URL else "")
+    state: Dict = {"application": None, "secret": secret}
+    server = build_web_app(state).listen(port, address="0.0.0.0")
+    logger.info(f"Web server (webhook {WEBHOOK_PATH}, /healthz, /metrics) started on port {port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Migrazioni in parallelo all'avvio del bot: set_webhook non attende il database
+    db = Database(DATABASE_URL)
+    db.init_schema_background()
+    application = build_application(db)
+    async with application:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=secret,
+            )
+            logger.info(f"Telegram webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL not set: webhook not registered with Telegram (local mode)")
+        await application.start()
+        await application.post_init(application)
+        state["application"] = application
+        logger.info("Bot started successfully! Milano Express Pricing v2.1 (webhook)")
+        await stop.wait()
+        state["application"] = None
+        await application.stop()
+        await application.post_shutdown(application)
+    server.stop()
+    db.close()
+
+
+def run_bot():
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook())
+        return
+
+    # Health check + /metrics (subito, prima delle migrazioni: Render aspetta la porta)
     health_thread = threading.Thread(target=start_health_server, daemon=True)
     health_thread.start()
     logger.info(f"Health check server started on port {os.environ.get('PORT', '10000')}")
 
-    # Init bot
-    bot_instance = MilanoExpressBot()
-
-    # Setup Telegram application
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    # Register handlers
-    application.add_handler(CommandHandler("start", bot_instance.start))
-    application.add_handler(CommandHandler("oggi", bot_instance.oggi))
-    application.add_handler(CommandHandler("domani", bot_instance.domani))
-    application.add_handler(CommandHandler("settimana", bot_instance.settimana))
-    application.add_handler(CommandHandler("eventi", bot_instance.eventi))
-    application.add_handler(CommandHandler("help", bot_instance.help_command))
+    # Init database in parallelo all'avvio del bot (le query attendono le migrazioni)
+    db = Database(DATABASE_URL)
+    db.init_schema_background()
 
+    application = build_application(db)
     logger.info("Bot started successfully! Milano Express Pricing v2.1")
 
-    # Run bot
+    # Run bot (polling)
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Server HTTP locale con le pagine registrate in fixtures/, per provare
+l'ingestione eventi e lo scraping competitor senza rete.
+
+    GET /feed        fixtures/fieramilano_feed.xml (ETag e Last-Modified, 304 sui GET condizionali)
+    GET /rooms/<id>  fixtures/rooms/<id>.html, calendario registrato di un competitor
+                     (stato JSON calendarMonths o celle calendar-day-DD/MM/YYYY)
+
+    python fixture_server.py --port 8091
+    EVENT_FEED_URL=http://localhost:8091/feed python bot.py
+    SCRAPER_CALENDAR_URL=http://localhost:8091/rooms/{airbnb_id} SCRAPER_MIN_INTERVAL=0 python bot.py
+
+Modificare il file della fixture cambia ETag e Last-Modified: il fetch
+successivo scarica di nuovo il feed, altrimenti riceve 304.
+"""
+
+import argparse
+import hashlib
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# (percorso, file in fixtures/ con i gruppi del percorso, content type)
+ROUTES = [
+    (re.compile(r"^/feed/?$"), "fieramilano_feed.xml", "application/rss+xml; charset=utf-8"),
+    (re.compile(r"^/rooms/(\d+)/?$"), "rooms/{0}.html", "text/html; charset=utf-8"),
+]
+
+
+def resolve(path: str) -> Optional[tuple]:
+    """(file, content type) per il percorso richiesto, None se non c'è una fixture"""
+    path = path.split("?", 1)[0]
+    for pattern, template, content_type in ROUTES:
+        match = pattern.match(path)
+        if match:
+            filename = os.path.join(FIXTURES_DIR, template.format(*match.groups()))
+            if os.path.isfile(filename):
+                return filename, content_type
+    return None
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        found = resolve(self.path)
+        if found is None:
+            self.send_error(404)
+            return
+        filename, content_type = found
+        with open(filename, "rb") as f:
+            body = f.read()
+        mtime = int(os.path.getmtime(filename))
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+        if self.headers.get("If-None-Match") == etag or self._not_modified_since(mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(mtime, usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified_since(self, mtime: int) -> bool:
+        # If-None-Match ha la precedenza quando presente (RFC 9110)
+        since = self.headers.get("If-Modified-Since")
+        if not since or self.headers.get("If-None-Match"):
+            return False
+        try:
+            return mtime <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server delle fixture registrate")
+    parser.add_argument("--port", type=int, default=8091)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FixtureHandler)
+    print(f"Fixture su http://127.0.0.1:{args.port} da {FIXTURES_DIR}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Load test degli handler del bot con N chat simulate.
+
+Gli update passano dalla pipeline reale (Application, limite per utente,
+handler, cache, pool DB); le chiamate verso Telegram vanno a un'API finta che
+registra i messaggi in uscita. Ogni chat invia un comando, attende la
+risposta (o le risposte) e dopo --think ms ne invia un altro.
+
+    python loadtest.py --chats 50 --duration 30
+    python loadtest.py --chats 200 --mix oggi=5,settimana=2,calendario=1 --no-cache
+    python loadtest.py --chats 20 --think 50 --throttle  # con il limite per utente di produzione
+    python loadtest.py --chats 5 --mix oggi=5,simula=1 --admin  # chat in ADMIN_USER_IDS: /simula eseguito
+    python loadtest.py --db postgres --save load_baseline.json
+    python loadtest.py --compare load_baseline.json --threshold 0.25
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import date
+from typing import Dict, List, Optional
+
+os.environ.setdefault("BOT_TOKEN", "0:loadtest")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/milano_bench")
+
+import bot  # noqa: E402
+import benchmark  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Risposte attese per comando: la latenza si misura fino all'ultima
+REPLIES = {"calendario": 2, "simula": 2}
+# Riservati ad ADMIN_USER_IDS: senza --admin rispondono solo "⛔" e non entrano nel report
+ADMIN_COMMANDS = {"simula", "ricarica"}
+THROTTLE_NOTICE = "⏳ Troppo veloce"
+DEFAULT_MIX = "oggi=5,domani=2,settimana=3,eventi=2,proprieta=1"
+
+
+class FakeTelegramAPI(BaseRequest):
+    """Client HTTP finto per python-telegram-bot: registra i messaggi e risponde come Telegram"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent: Dict[str, int] = {}
+        self.waiters: Dict[int, list] = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def expect(self, chat_id: int, replies: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = [replies, future]
+        return future
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> tuple:
+        endpoint = url.rsplit("/", 1)[-1]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Milano Express", "username": "loadtest_bot"}
+        elif endpoint.startswith("send"):
+            self.sent[endpoint] = self.sent.get(endpoint, 0) + 1
+            chat_id = int(request_data.parameters["chat_id"]) if request_data else 0
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "",
+            }
+            waiter = self.waiters.get(chat_id)
+            text = str(request_data.parameters.get("text", "")) if request_data else ""
+            if waiter and text.startswith(THROTTLE_NOTICE):
+                # Avviso del limite per utente: il comando non avrà altre risposte
+                if not waiter[1].done():
+                    waiter[1].set_result(None)
+            elif waiter:
+                waiter[0] -= 1
+                if waiter[0] <= 0 and not waiter[1].done():
+                    waiter[1].set_result(time.perf_counter())
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """'oggi=5,settimana=2' -> {'oggi': 5.0, 'settimana': 2.0}"""
+    mix = {}
+    for part in spec.split(","):
+        command, _, weight = part.partition("=")
+        mix[command.strip().lstrip("/")] = float(weight or 1)
+    return mix
+
+
+def command_update(application, update_id: int, chat_id: int, command: str):
+    text = f"/{command}"
+    return bot.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"Chat {chat_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }, application.bot)
+
+
+def percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run_load(args) -> Dict:
+    today = date.today()
+    db = benchmark.open_database(args.db, benchmark.dense_events(today), benchmark.synthetic_market(today))
+    handlers = bot.MilanoExpressBot(db)
+    if args.no_cache:
+        handlers.replies = bot.ResponseCache(max_size=0)
+    if args.db == "fake":
+        handlers.portfolio.refresh_all()
+    if not args.throttle:
+        # Di default si misura la capacità degli handler, non il limite per utente
+        handlers.throttle = None
+    if args.admin:
+        bot.ADMIN_USER_IDS.update(100000 + i for i in range(args.chats))
+
+    api = FakeTelegramAPI(args.api_latency / 1000)
+    application = bot.build_application(db, handlers, request=api)
+    # Solo handler: niente scraping, feed o digest durante la misura
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+
+    mix = parse_mix(args.mix)
+    commands, weights = list(mix), list(mix.values())
+    latencies: Dict[str, List[float]] = {command: [] for command in commands}
+    timeouts: Dict[str, int] = {command: 0 for command in commands}
+    throttled: Dict[str, int] = {command: 0 for command in commands}
+    counter = iter(range(1, 10 ** 9))
+    rng = random.Random(args.seed)
+
+    async def chat(chat_id: int, deadline: float):
+        while time.perf_counter() < deadline:
+            command = rng.choices(commands, weights)[0]
+            refused = command in ADMIN_COMMANDS and not args.admin
+            done = api.expect(chat_id, 1 if refused else REPLIES.get(command, 1))
+            started = time.perf_counter()
+            await application.update_queue.put(command_update(application, next(counter), chat_id, command))
+            try:
+                finished = await asyncio.wait_for(done, args.timeout)
+                if finished is None:
+                    throttled[command] += 1
+                else:
+                    latencies[command].append((finished - started) * 1000)
+            except asyncio.TimeoutError:
+                # Nessuna risposta: comando rifiutato dopo l'avviso del limite, o handler bloccato
+                timeouts[command] += 1
+            if args.think:
+                await asyncio.sleep(rng.uniform(0, 2 * args.think / 1000))
+
+    async with application:
+        await application.start()
+        await application.post_init(application)
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(chat(100000 + i, deadline) for i in range(args.chats)))
+        elapsed = time.perf_counter() - started
+        await application.stop()
+        await application.post_shutdown(application)
+    db.close()
+
+    if not args.admin:
+        for command in ADMIN_COMMANDS & set(commands):
+            # Misurerebbero solo il rifiuto, non il comando
+            latencies[command], timeouts[command], throttled[command] = [], 0, 0
+            commands.remove(command)
+
+    cases = {}
+    for command in commands:
+        values = sorted(latencies[command])
+        if not values:
+            continue
+        cases[f"load/{command}"] = {
+            "median_ms": round(statistics.median(values), 3),
+            "p95_ms": round(percentile(values, 0.95), 3),
+            "p99_ms": round(percentile(values, 0.99), 3),
+            "max_ms": round(values[-1], 3),
+            "replies": len(values),
+            "timeouts": timeouts[command],
+            "throttled": throttled[command],
+            "throughput_rps": round(len(values) / elapsed, 2),
+        }
+    return {
+        "meta": {
+            "db": args.db,
+            "chats": args.chats,
+            "duration_s": round(elapsed, 2),
+            "mix": args.mix,
+            "cache": not args.no_cache,
+            "throttle": args.throttle,
+            "admin": args.admin,
+            "api_latency_ms": args.api_latency,
+            "update_workers": application.update_processor.max_concurrent_updates,
+            "python": platform.python_version(),
+            "date": date.today().isoformat(),
+        },
+        "total": {
+            "replies": sum(len(v) for v in latencies.values()),
+            "timeouts": sum(timeouts.values()),
+            "throttled": sum(throttled.values()),
+            "throughput_rps": round(sum(len(v) for v in latencies.values()) / elapsed, 2),
+            "sent": api.sent,
+        },
+        "cases": cases,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test Milano Express Pricing Bot")
+    parser.add_argument("--db", choices=("fake", "postgres"), default="fake")
+    parser.add_argument("--chats", type=int, default=50, help="chat simulate in parallelo")
+    parser.add_argument("--duration", type=float, default=20, help="secondi di carico")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comandi e pesi, es. oggi=5,calendario=1")
+    parser.add_argument("--think", type=float, default=200, help="pausa media tra comandi di una chat (ms)")
+    parser.add_argument("--api-latency", type=float, default=0, help="latenza simulata delle API Telegram (ms)")
+    parser.add_argument("--timeout", type=float, default=10, help="attesa massima di una risposta (s)")
+    parser.add_argument("--no-cache", action="store_true", help="disattiva la cache risposte")
+    parser.add_argument("--throttle", action="store_true", help="applica il limite per utente (CHAT_RATE_*)")
+    parser.add_argument("--admin", action="store_true", help="chat simulate in ADMIN_USER_IDS (/simula, /ricarica)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", metavar="FILE", help="scrive i risultati JSON (nuova baseline)")
+    parser.add_argument("--compare", metavar="FILE", help="baseline JSON da confrontare")
+    parser.add_argument("--threshold", type=float, default=0.25, help="peggioramento massimo della mediana")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run_load(args))
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = benchmark.compare(results, json.load(f), args.threshold)
+
+    meta, total = results["meta"], results["total"]
+    print(
+        f"{meta['chats']} chat, {meta['duration_s']}s, cache {'on' if meta['cache'] else 'off'}, "
+        f"throttle {'on' if meta['throttle'] else 'off'}, {meta['update_workers']} worker"
+    )
+    skipped = sorted(ADMIN_COMMANDS & set(parse_mix(meta["mix"]))) if not meta["admin"] else []
+    if skipped:
+        print(f"{', '.join(skipped)}: riservati agli admin, esclusi dal report (usa --admin)")
+    for name, result in results["cases"].items():
+        change = f"  {result['change']:+.0%}" if "change" in result else ""
+        print(
+            f"{name:<18} {result['throughput_rps']:>8.1f} rps  p50 {result['median_ms']:>8.2f}ms  "
+            f"p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms  "
+            f"timeout {result['timeouts']}  limitati {result['throttled']}{change}"
+        )
+    print(f"{'totale':<18} {total['throughput_rps']:>8.1f} rps  {total['replies']} risposte, "
+          f"{total['timeouts']} timeout, {total['throttled']} limitati")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"\nRegressioni oltre {args.threshold:.0%}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Channel manager finto per provare il push prezzi in locale.
+
+Implementa l'API JSON di HttpChannelManager e tiene i prezzi in memoria:
+
+    POST /listings/<id>/rates   {"currency": "EUR", "rates": [{"start", "end", "price"}, ...]}
+    GET  /listings/<id>/rates   calendario {data: prezzo}
+    GET  /stats                 chiamate ricevute, range e date aggiornate
+
+    python mock_channel_manager.py --port 8090 --fail-every 3
+    CHANNEL_MANAGER_URL=http://localhost:8090 python bot.py push
+
+Con --fail-every N una chiamata su N risponde 503 (o 429 con Retry-After
+se --retry-after > 0), per verificare retry e ripresa del push.
+"""
+
+import argparse
+import json
+import re
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+RATES_PATH = re.compile(r"^/listings/([^/]+)/rates$")
+
+
+class MockChannelManager:
+    def __init__(self, fail_every: int = 0, retry_after: int = 0, token: str = ""):
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.token = token
+        self.calendars: Dict[str, Dict[str, float]] = {}
+        self.stats = {"requests": 0, "failed": 0, "ranges": 0, "dates": 0}
+        self._lock = threading.Lock()
+
+    def push(self, listing: str, payload: Dict) -> int:
+        """Applica i range; restituisce lo status HTTP"""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.fail_every and self.stats["requests"] % self.fail_every == 0:
+                self.stats["failed"] += 1
+                return 429 if self.retry_after else 503
+            calendar = self.calendars.setdefault(listing, {})
+            for rate in payload["rates"]:
+                start, end = date.fromisoformat(rate["start"]), date.fromisoformat(rate["end"])
+                for i in range((end - start).days + 1):
+                    calendar[(start + timedelta(days=i)).isoformat()] = float(rate["price"])
+                    self.stats["dates"] += 1
+                self.stats["ranges"] += 1
+            return 200
+
+
+def build_handler(state: MockChannelManager):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: Dict, headers: Dict = None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            match = RATES_PATH.match(self.path)
+            if self.path == "/stats":
+                self._reply(200, state.stats)
+            elif match:
+                self._reply(200, state.calendars.get(match.group(1), {}))
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            match = RATES_PATH.match(self.path)
+            if not match:
+                self._reply(404, {"error": "not found"})
+                return
+            if state.token and self.headers.get("Authorization") != f"Bearer {state.token}":
+                self._reply(401, {"error": "unauthorized"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                status = state.push(match.group(1), payload)
+            except (KeyError, TypeError, ValueError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            if status == 200:
+                self._reply(200, {"ok": True, "rates": len(payload["rates"])})
+            else:
+                headers = {"Retry-After": str(state.retry_after)} if status == 429 else None
+                self._reply(status, {"error": "unavailable"}, headers)
+
+        def log_message(self, format, *args):
+            print(f"{self.command} {self.path} -> {args[1] if len(args) > 1 else ''}")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Channel manager finto per il push prezzi")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail-every", type=int, default=0, help="una chiamata POST su N fallisce")
+    parser.add_argument("--retry-after", type=int, default=0, help="fallimenti come 429 con Retry-After (s)")
+    parser.add_argument("--token", default="", help="Bearer token richiesto (CHANNEL_MANAGER_TOKEN)")
+    args = parser.parse_args()
+
+    state = MockChannelManager(args.fail_every, args.retry_after, args.token)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), build_handler(state))
+    print(f"Mock channel manager su http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()